@@ -43,6 +43,8 @@ while True:
 
 		if comment_created <= end_time:
 			log.info(f"{count} : {(comment_created.strftime('%Y-%m-%d'))}")
+			# the comments were added without touching the history, so count them in now
+			database.rebuild_user_history()
 			database.session.commit()
 			database.engine.dispose()
 			sys.exit()
@@ -72,4 +74,6 @@ while True:
 			log.info(f"{count} : {(comment_created.strftime('%Y-%m-%d'))}")
 			database.session.commit()
 
+database.rebuild_user_history()
+database.session.commit()
 database.engine.dispose()
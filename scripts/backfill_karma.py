@@ -51,5 +51,6 @@ for comment in comments:
 		fullnames = []
 
 log.info(f"Done {len(comments)}")
+database.rebuild_user_history()
 database.session.commit()
 database.engine.dispose()
@@ -0,0 +1,119 @@
+import argparse
+import logging
+import os
+import random
+import statistics
+import time
+from datetime import datetime
+from types import SimpleNamespace
+import discord_logging
+
+log = discord_logging.init_logging()
+
+import bayarea
+import shared
+from classes import Queue
+from database import User, Database
+from generate_dataset import SUBREDDIT_ID, generate
+
+# times the database heavy parts of the loop against synthetic databases of increasing size. datasets are generated
+# once per scale into the folder and reused on later runs, delete them to regenerate
+
+
+def benchmark_subreddit():
+	# just the attributes the benchmarked functions read. the karma backfill gets no reddit results back, so only its
+	# null scan is timed
+	return SimpleNamespace(
+		name="bayarea",
+		case_sensitive_name="bayarea",
+		sub_id=SUBREDDIT_ID,
+		approved=[],
+		restricted={'comment_days': 30, 'comments': 20, 'karma': 20},
+		reddit=None,
+		non_mod_reddit=None,
+		recent_overlaps=Queue(50),
+		get_discord_name=lambda name: name,
+		post_to_discord=lambda message: None,
+		mod_pool=SimpleNamespace(info=lambda fullnames, task=None: None),
+	)
+
+
+def sample_users(database, count):
+	# the heaviest posters plus a spread of everyone else, user ids are the popularity rank
+	max_id = database.session.query(User.id).order_by(User.id.desc()).limit(1).scalar()
+	user_ids = list(range(1, 6)) + random.sample(range(6, max_id + 1), min(count - 5, max_id - 5))
+	return database.session.query(User).filter(User.id.in_(user_ids)).all()
+
+
+def run_purge(database):
+	database.purge()
+	database.session.rollback()
+
+
+def build_benchmarks(database, subreddit, users):
+	now = datetime.utcnow()
+	return [
+		("get_user_counts", lambda: [database.get_user_counts(SUBREDDIT_ID, user, now) for user in users]),
+		("author_comment_restricted", lambda: [bayarea.author_comment_restricted(subreddit, database, user, save_profile_time=False) for user in users]),
+		("authors_comment_restricted bulk", lambda: bayarea.authors_comment_restricted(subreddit, database, users, save_profile_time=False)),
+		("purge", lambda: run_purge(database)),
+		("update_object_counts", database.update_object_counts),
+		("post_overlapping_actions", lambda: shared.post_overlapping_actions(subreddit, database)),
+		("backfill_karma null scan", lambda: bayarea.backfill_karma(subreddit, database)),
+	]
+
+
+def run_scale(folder, comments, repeat, sample_size):
+	location = os.path.join(folder, f"benchmark_{comments}.db")
+	if os.path.exists(location):
+		database = Database(location)
+	else:
+		database = generate(location, comments)
+
+	random.seed(0)
+	users = sample_users(database, sample_size)
+	subreddit = benchmark_subreddit()
+	results = {}
+	for name, benchmark in build_benchmarks(database, subreddit, users):
+		times = []
+		# the benchmarked functions log every item they act on
+		discord_logging.set_level(logging.WARNING)
+		for _ in range(repeat):
+			start_time = time.perf_counter()
+			benchmark()
+			times.append(time.perf_counter() - start_time)
+		discord_logging.set_level(logging.INFO)
+		results[name] = statistics.median(times)
+		log.info(f"{format_scale(comments)}: {name} {results[name] * 1000:.1f} ms")
+	database.session.rollback()
+	database.close()
+	return results
+
+
+def format_scale(comments):
+	if comments >= 1000000:
+		return f"{comments / 1000000:g}M"
+	if comments >= 1000:
+		return f"{comments / 1000:g}k"
+	return str(comments)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Time the database queries at several dataset sizes")
+	parser.add_argument("--scales", help="Comma separated comment counts to test", default="100000,1000000")
+	parser.add_argument("--folder", help="Folder to keep the generated datasets in", default="benchmark")
+	parser.add_argument("--repeat", help="Runs of each query, the median is reported", type=int, default=5)
+	parser.add_argument("--users", help="Users to look up for the per user queries", type=int, default=50)
+	args = parser.parse_args()
+
+	if not os.path.exists(args.folder):
+		os.makedirs(args.folder)
+	scales = [int(scale) for scale in args.scales.split(",")]
+
+	all_results = {scale: run_scale(args.folder, scale, args.repeat, args.users) for scale in scales}
+
+	names = list(all_results[scales[0]])
+	log.info(f"Median of {args.repeat} runs in milliseconds, per user queries are for {args.users} users")
+	log.info(f"{'query':<34}" + "".join(f"{format_scale(scale):>12}" for scale in scales))
+	for name in names:
+		log.info(f"{name:<34}" + "".join(f"{all_results[scale][name] * 1000:>12.1f}" for scale in scales))
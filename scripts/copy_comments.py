@@ -47,5 +47,7 @@ if __name__ == "__main__":
 			database_prod.session.commit()
 
 	log.info(f"{count}/{total_comments}: {new_submissions}|{new_users}")
+	# the comments were added without touching the history, so count them in now
+	database_prod.rebuild_user_history()
 	database_prod.close()
 	database_new.close()
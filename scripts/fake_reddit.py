@@ -0,0 +1,764 @@
+import argparse
+import base64
+import json
+import random
+import re
+import threading
+import time
+import uuid
+import zlib
+from collections import defaultdict
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import discord_logging
+
+log = discord_logging.init_logging()
+
+import static
+from reddit_requestor import normalize_endpoint
+
+# a local stand in for the parts of the reddit api the bot uses, serving a synthetic workload so we can see how the
+# loop holds up at volumes we don't have yet. point every account at it in praw.ini
+#   oauth_url = http://localhost:8080
+#   reddit_url = http://localhost:8080
+# then run main.py as usual. the rates apply to each subreddit, for example 10x comment volume with a full modqueue
+#   python fake_reddit.py --comments-per-second 50 --modqueue 1000
+
+MODERATORS = {
+	"CompetitiveOverwatch": static.COMPOW_MODERATORS,
+	"bayarea": static.BAYAREA_MODERATORS,
+}
+# accounts that can see the comments of users with private profiles
+MOD_ACCOUNTS = {"CustomModBot", "Watchful1"}
+FLAIRS = ["Discussion", "News", "Question", "Events", "Politics", "Local Crime", "COVID19"]
+MODMAIL_STATES = {"all": 1, "archived": 2, "appeals": 8}
+REPORT_REASONS = ["Spam", "This is misinformation", "Breaks r/{subreddit} rules", "Harassment"]
+LISTING_DEPTH = 1000
+
+
+def base36(number):
+	digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+	result = ""
+	while number:
+		number, remainder = divmod(number, 36)
+		result = digits[remainder] + result
+	return result or "0"
+
+
+def modmail_time(timestamp):
+	return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f+00:00")
+
+
+def listing(children, after=None):
+	return {'kind': "Listing", 'data': {'children': children, 'after': after, 'before': None, 'dist': len(children)}}
+
+
+class FakeSubreddit:
+	def __init__(self, name, sub_id, moderators):
+		self.name = name
+		self.sub_id = sub_id
+		self.moderators = list(moderators) or ["FakeModerator"]
+		# fullnames and log ids are kept oldest first, listings walk them backwards
+		self.submissions = []
+		self.comments = []
+		self.mod_log = []
+		self.modqueue = {}
+		self.unmoderated = {}
+		self.conversations = {}
+		self.contributors = []
+		self.banned = set()
+		self.wiki = defaultdict(list)
+
+
+class FakeReddit:
+	def __init__(self, args):
+		self.args = args
+		self.lock = threading.RLock()
+		self.next_id = 36 ** 5
+		self.things = {}
+		self.replies = defaultdict(list)
+		self.positions = {}
+		self.log_items = {}
+		self.tokens = {}
+		self.ratelimits = {}
+		self.requests = defaultdict(int)
+		self.limited = 0
+		self.carry = defaultdict(float)
+
+		self.users = [f"fake_user_{index}" for index in range(args.users)]
+		self.private_users = set(random.sample(self.users, int(len(self.users) * args.private_share)))
+		self.user_comments = defaultdict(list)
+		self.subreddits = {}
+		for index, name in enumerate(args.subreddits.split(",")):
+			subreddit = FakeSubreddit(name, base36(36 ** 4 + index), MODERATORS.get(name, []))
+			subreddit.contributors = random.sample(self.users, min(50, len(self.users)))
+			self.save_wiki(subreddit, "usernotes", self.empty_usernotes(), subreddit.moderators[0], "created")
+			self.subreddits[name.lower()] = subreddit
+
+	def new_id(self):
+		with self.lock:
+			self.next_id += 1
+			return base36(self.next_id)
+
+	@staticmethod
+	def empty_usernotes():
+		blob = base64.b64encode(zlib.compress(b"{}")).decode()
+		return json.dumps({'ver': 6, 'constants': {'users': [], 'warnings': []}, 'blob': blob})
+
+	def save_wiki(self, subreddit, page, content, author, reason):
+		revision = {'id': str(uuid.uuid4()), 'content': content, 'author': author, 'reason': reason, 'timestamp': time.time()}
+		subreddit.wiki[page].append(revision)
+		return revision
+
+	def add_submission(self, subreddit, created=None, author=None):
+		submission_id = self.new_id()
+		fullname = f"t3_{submission_id}"
+		author = author or random.choice(self.users)
+		self.things[fullname] = {
+			'id': submission_id, 'name': fullname, 'title': f"Fake submission {submission_id}", 'author': author,
+			'created_utc': created or time.time(), 'subreddit': subreddit.name, 'subreddit_id': f"t5_{subreddit.sub_id}",
+			'permalink': f"/r/{subreddit.name}/comments/{submission_id}/fake_submission/",
+			'url': f"https://www.reddit.com/r/{subreddit.name}/comments/{submission_id}/fake_submission/",
+			'selftext': "Synthetic submission", 'is_self': True, 'link_flair_text': random.choice(FLAIRS), 'score': 1, 'ups': 1,
+			'num_comments': 0, 'removed_by_category': None, 'banned_by': None, 'removed': False, 'spam': False,
+			'approved': False, 'approved_by': None, 'mod_reports': [], 'user_reports': [], 'locked': False,
+			'over_18': False, 'stickied': False, 'distinguished': None, 'ignore_reports': False, 'discussion_type': None,
+			'is_reddit_media_domain': False,
+		}
+		self.positions[fullname] = len(subreddit.submissions)
+		subreddit.submissions.append(fullname)
+		subreddit.unmoderated[fullname] = True
+		return fullname
+
+	def add_comment(self, subreddit, created=None, author=None, parent=None, body=None):
+		if parent is None:
+			if not subreddit.submissions:
+				self.add_submission(subreddit)
+			# most comments land on the newest few threads, and some are replies to earlier comments
+			submission = self.things[random.choice(subreddit.submissions[-20:])]
+			parent = submission['name']
+			thread_replies = self.replies[parent]
+			if thread_replies and random.random() < self.args.reply_share:
+				parent = random.choice(thread_replies[-50:])
+		parent_thing = self.things[parent]
+		link_id = parent_thing['link_id'] if parent.startswith("t1_") else parent
+		comment_id = self.new_id()
+		fullname = f"t1_{comment_id}"
+		author = author or random.choice(self.users)
+		self.things[fullname] = {
+			'id': comment_id, 'name': fullname, 'link_id': link_id, 'parent_id': parent, 'author': author,
+			'body': body or f"Synthetic comment {comment_id}", 'created_utc': created or time.time(),
+			'subreddit': subreddit.name, 'subreddit_id': f"t5_{subreddit.sub_id}",
+			'permalink': f"/r/{subreddit.name}/comments/{link_id[3:]}/fake_submission/{comment_id}/", 'score': 1, 'ups': 1,
+			'removed': False, 'banned_by': None, 'approved': False, 'approved_by': None, 'mod_reports': [], 'user_reports': [],
+			'distinguished': None, 'stickied': False, 'locked': False, 'spam': False, 'ignore_reports': False, 'edited': False,
+		}
+		self.replies[parent].append(fullname)
+		self.things[link_id]['num_comments'] += 1
+		self.positions[fullname] = len(subreddit.comments)
+		subreddit.comments.append(fullname)
+		self.user_comments[author].append(fullname)
+		return fullname
+
+	def add_report(self, subreddit):
+		candidates = subreddit.comments[-max(LISTING_DEPTH, self.args.modqueue):] + subreddit.submissions[-100:]
+		if not candidates:
+			return
+		fullname = random.choice(candidates)
+		thing = self.things[fullname]
+		if thing['removed']:
+			return
+		reason = random.choice(REPORT_REASONS).format(subreddit=subreddit.name)
+		for report in thing['user_reports']:
+			if report[0] == reason:
+				report[1] += 1
+				break
+		else:
+			thing['user_reports'].append([reason, 1, False, False])
+		thing['approved'] = False
+		subreddit.modqueue[fullname] = True
+
+	def add_mod_action(self, subreddit, mod, action, fullname=None, details=None):
+		thing = self.things.get(fullname, {})
+		log_id = f"ModAction_{uuid.uuid4()}"
+		self.log_items[log_id] = {
+			'id': log_id, 'action': action, 'mod': mod, 'created_utc': time.time(), 'subreddit': subreddit.name,
+			'sr_id36': subreddit.sub_id, 'details': details, 'description': None, 'target_author': thing.get('author'),
+			'target_fullname': fullname, 'target_permalink': thing.get('permalink'), 'target_title': thing.get('title'),
+			'target_body': thing.get('body'),
+		}
+		self.positions[log_id] = len(subreddit.mod_log)
+		subreddit.mod_log.append(log_id)
+
+	def add_conversation(self, subreddit, author, body, created=None, sender=None, internal=False, state="all"):
+		conversation_id = self.new_id()
+		created = created or time.time()
+		conversation = {
+			'id': conversation_id, 'subject': f"Fake modmail {conversation_id}", 'state': state, 'author': author,
+			'is_internal': internal, 'is_highlighted': False, 'messages': [], 'last_updated': created,
+			'last_user_update': None, 'last_mod_update': None, 'last_unread': created,
+		}
+		subreddit.conversations[conversation_id] = conversation
+		self.add_message(subreddit, conversation, sender or author, body, created)
+		return conversation
+
+	def add_message(self, subreddit, conversation, author, body, created=None, internal=False):
+		created = created or time.time()
+		conversation['messages'].append({
+			'id': self.new_id(), 'author': author, 'body': body, 'internal': internal, 'date': created})
+		conversation['last_updated'] = created
+		if author in subreddit.moderators or author in MOD_ACCOUNTS:
+			conversation['last_mod_update'] = created
+		else:
+			conversation['last_user_update'] = created
+			conversation['last_unread'] = created
+			if conversation['state'] == "archived":
+				conversation['state'] = "all"
+
+	def moderate(self, subreddit, fullname, mod, action):
+		thing = self.things[fullname]
+		kind = "comment" if fullname.startswith("t1_") else "link"
+		if action == "remove":
+			thing['removed'] = True
+			thing['banned_by'] = mod
+			if kind == "link":
+				thing['removed_by_category'] = "moderator"
+		else:
+			thing['removed'] = False
+			thing['banned_by'] = None
+			thing['removed_by_category'] = None
+			thing['approved'] = True
+			thing['approved_by'] = mod
+		thing['mod_reports'] = []
+		thing['user_reports'] = []
+		subreddit.modqueue.pop(fullname, None)
+		subreddit.unmoderated.pop(fullname, None)
+		self.add_mod_action(subreddit, mod, f"{action}{kind}", fullname)
+
+	def seed(self):
+		now = time.time()
+		for subreddit in self.subreddits.values():
+			for index in range(self.args.initial_submissions):
+				self.add_submission(subreddit, created=now - 86400 + index * 86400 / self.args.initial_submissions)
+			for index in range(self.args.initial_comments):
+				self.add_comment(subreddit, created=now - 3600 + index * 3600 / self.args.initial_comments)
+			for _ in range(self.args.modqueue * 10):
+				if len(subreddit.modqueue) >= self.args.modqueue:
+					break
+				self.add_report(subreddit)
+			for index in range(self.args.initial_modmail):
+				self.add_conversation(subreddit, random.choice(self.users), "Synthetic modmail", created=now - index * 600)
+			log.info(
+				f"r/{subreddit.name}: {len(subreddit.submissions)} submissions, {len(subreddit.comments)} comments, "
+				f"{len(subreddit.modqueue)} in modqueue, {len(subreddit.conversations)} modmails")
+
+	def due(self, key, per_second, elapsed):
+		self.carry[key] += per_second * elapsed
+		count = int(self.carry[key])
+		self.carry[key] -= count
+		return count
+
+	def tick(self, elapsed):
+		with self.lock:
+			for subreddit in self.subreddits.values():
+				for _ in range(self.due((subreddit.name, "submissions"), self.args.submissions_per_minute / 60, elapsed)):
+					self.add_submission(subreddit)
+				for _ in range(self.due((subreddit.name, "comments"), self.args.comments_per_second, elapsed)):
+					self.add_comment(subreddit)
+				for _ in range(self.due((subreddit.name, "reports"), self.args.reports_per_minute / 60, elapsed)):
+					self.add_report(subreddit)
+				for _ in range(self.due((subreddit.name, "modmail"), self.args.modmail_per_minute / 60, elapsed)):
+					if subreddit.conversations and random.random() < 0.3:
+						conversation = random.choice(list(subreddit.conversations.values())[-100:])
+						self.add_message(subreddit, conversation, conversation['author'], "Synthetic reply")
+					elif random.random() < 0.1:
+						self.add_conversation(subreddit, "AutoModerator", "Synthetic automoderator report")
+					else:
+						self.add_conversation(subreddit, random.choice(self.users), "Synthetic modmail")
+				for _ in range(self.due((subreddit.name, "actions"), self.args.actions_per_minute / 60, elapsed)):
+					# other moderators work through the queues too
+					queue = subreddit.modqueue or subreddit.unmoderated
+					if queue:
+						fullname = random.choice(list(queue)[:100])
+						self.moderate(subreddit, fullname, random.choice(subreddit.moderators), random.choice(["remove", "approve"]))
+
+	def generate(self):
+		last_tick = time.monotonic()
+		while True:
+			time.sleep(1)
+			now = time.monotonic()
+			self.tick(now - last_tick)
+			last_tick = now
+
+	def count(self, key):
+		with self.lock:
+			self.requests[key] += 1
+
+	def ratelimit(self, account):
+		# a fixed window per account, like the x-ratelimit headers reddit sends
+		now = time.time()
+		with self.lock:
+			window_start, used = self.ratelimits.get(account, (now, 0))
+			if now - window_start >= self.args.ratelimit_window:
+				window_start, used = now, 0
+			allowed = used < self.args.ratelimit
+			if allowed:
+				used += 1
+			else:
+				self.limited += 1
+			self.ratelimits[account] = (window_start, used)
+		headers = {
+			'x-ratelimit-used': str(used),
+			'x-ratelimit-remaining': f"{max(self.args.ratelimit - used, 0):.1f}",
+			'x-ratelimit-reset': str(max(int(window_start + self.args.ratelimit_window - now), 0)),
+		}
+		return allowed, headers
+
+	def thing(self, fullname):
+		thing = self.things[fullname]
+		data = dict(thing, num_reports=len(thing['user_reports']) + len(thing['mod_reports']))
+		if fullname.startswith("t1_"):
+			data['replies'] = ""
+		return {'kind': fullname[:2], 'data': data}
+
+	def comment_tree(self, fullname):
+		tree = self.thing(fullname)
+		children = [self.comment_tree(child) for child in self.replies[fullname]]
+		tree['data']['replies'] = listing(children) if children else ""
+		return tree
+
+	def page(self, keys, params, render, use_positions=True):
+		# keys are oldest first, return the newest page before the after cursor
+		limit = min(int(params.get('limit', 25)), 100)
+		after = params.get('after')
+		end = len(keys)
+		if after is not None:
+			if use_positions and after in self.positions:
+				end = self.positions[after]
+			elif after in keys:
+				end = keys.index(after)
+		start = max(end - limit, len(keys) - LISTING_DEPTH, 0)
+		children = [render(key) for key in reversed(keys[start:end])]
+		next_after = keys[start] if children and start > max(len(keys) - LISTING_DEPTH, 0) else None
+		return listing(children, next_after)
+
+	def author(self, subreddit, name):
+		is_mod = name in subreddit.moderators or name in MOD_ACCOUNTS
+		return {
+			'id': zlib.crc32(name.encode()), 'name': name, 'isMod': is_mod, 'isAdmin': False, 'isOp': False,
+			'isParticipant': not is_mod, 'isApproved': False, 'isHidden': False, 'isDeleted': False}
+
+	def render_conversation(self, subreddit, conversation):
+		messages = {}
+		authors = []
+		for message in conversation['messages']:
+			author = self.author(subreddit, message['author'])
+			if author['name'] not in [existing['name'] for existing in authors]:
+				authors.append(author)
+			messages[message['id']] = {
+				'id': message['id'], 'body': f"<p>{message['body']}</p>", 'bodyMarkdown': message['body'],
+				'author': author, 'isInternal': message['internal'], 'date': modmail_time(message['date'])}
+		data = {
+			'id': conversation['id'], 'subject': conversation['subject'], 'state': MODMAIL_STATES[conversation['state']],
+			'isHighlighted': conversation['is_highlighted'], 'isInternal': conversation['is_internal'], 'isAuto': False,
+			'isRepliable': True, 'lastUpdated': modmail_time(conversation['last_updated']),
+			'lastUserUpdate': modmail_time(conversation['last_user_update']) if conversation['last_user_update'] else None,
+			'lastModUpdate': modmail_time(conversation['last_mod_update']) if conversation['last_mod_update'] else None,
+			'lastUnread': modmail_time(conversation['last_unread']) if conversation['last_unread'] else None,
+			'numMessages': len(messages), 'objIds': [{'id': message_id, 'key': "messages"} for message_id in messages],
+			'authors': authors, 'participant': self.author(subreddit, conversation['author']),
+			'owner': {'displayName': subreddit.name, 'type': "subreddit", 'id': f"t5_{subreddit.sub_id}"},
+			'legacyFirstMessageId': None,
+		}
+		return data, messages
+
+	def fetched_conversation(self, subreddit, conversation):
+		data, messages = self.render_conversation(subreddit, conversation)
+		return {'conversation': data, 'messages': messages, 'modActions': {}}
+
+	def find_conversation(self, conversation_id):
+		for subreddit in self.subreddits.values():
+			if conversation_id in subreddit.conversations:
+				return subreddit, subreddit.conversations[conversation_id]
+		return None, None
+
+	def subreddit_for(self, fullname):
+		return self.subreddits[self.things[fullname]['subreddit'].lower()]
+
+
+class FakeRedditHandler(BaseHTTPRequestHandler):
+	reddit = None
+	routes = []
+	protocol_version = "HTTP/1.1"
+
+	def log_message(self, format, *args):
+		pass
+
+	def do_GET(self):
+		self.handle_request("GET")
+
+	def do_POST(self):
+		self.handle_request("POST")
+
+	def do_DELETE(self):
+		self.handle_request("DELETE")
+
+	def handle_request(self, method):
+		parsed = urlparse(self.path)
+		path = parsed.path.rstrip('/')
+		if path.endswith('.json'):
+			path = path[:-5]
+		params = {key: values[-1] for key, values in parse_qs(parsed.query).items()}
+		length = int(self.headers.get('Content-Length', 0))
+		if length:
+			params.update({key: values[-1] for key, values in parse_qs(self.rfile.read(length).decode()).items()})
+
+		if path == "/api/v1/access_token":
+			token = f"fake-{params.get('username', 'anonymous')}-{uuid.uuid4().hex[:8]}"
+			self.reddit.tokens[token] = params.get('username', "anonymous")
+			self.respond(200, {'access_token': token, 'expires_in': 86400, 'scope': "*", 'token_type': "bearer"})
+			return
+
+		account = self.reddit.tokens.get(self.headers.get('Authorization', "").split(" ")[-1], "anonymous")
+		self.reddit.count(f"{method} {normalize_endpoint(path)}")
+		allowed, headers = self.reddit.ratelimit(account)
+		if self.reddit.args.latency:
+			time.sleep(self.reddit.args.latency)
+		if not allowed:
+			self.respond(429, {'message': "Too Many Requests", 'error': 429}, headers)
+			return
+
+		for route_method, pattern, handler in self.routes:
+			if route_method == method:
+				match = pattern.fullmatch(path)
+				if match:
+					with self.reddit.lock:
+						try:
+							status, body = handler(self.reddit, account, params, *match.groups())
+						except KeyError:
+							status, body = 404, {'message': "Not Found", 'error': 404}
+					self.respond(status, body, headers)
+					return
+
+		self.reddit.count(f"unhandled {method} {normalize_endpoint(path)}")
+		self.respond(404, {'message': "Not Found", 'error': 404}, headers)
+
+	def respond(self, status, body, headers=None):
+		content = json.dumps(body).encode()
+		self.send_response(status)
+		self.send_header('Content-Type', "application/json; charset=UTF-8")
+		self.send_header('Content-Length', str(len(content)))
+		for header, value in (headers or {}).items():
+			self.send_header(header, value)
+		self.end_headers()
+		self.wfile.write(content)
+
+
+def route(method, pattern):
+	def decorator(func):
+		FakeRedditHandler.routes.append((method, re.compile(pattern), func))
+		return func
+	return decorator
+
+
+def subreddit_by_name(reddit, name):
+	return reddit.subreddits[name.lower()]
+
+
+@route("GET", r"/api/v1/me")
+def get_me(reddit, account, params):
+	return 200, {'name': account, 'id': base36(zlib.crc32(account.encode())), 'created_utc': 1300000000}
+
+
+@route("GET", r"/r/([^/]+)/about")
+def get_about(reddit, account, params, name):
+	subreddit = subreddit_by_name(reddit, name)
+	return 200, {'kind': "t5", 'data': {
+		'display_name': subreddit.name, 'id': subreddit.sub_id, 'name': f"t5_{subreddit.sub_id}", 'subscribers': 100000,
+		'user_is_moderator': account in MOD_ACCOUNTS, 'over18': False}}
+
+
+@route("GET", r"/r/([^/]+)/about/log")
+def get_log(reddit, account, params, name):
+	subreddit = subreddit_by_name(reddit, name)
+	return 200, reddit.page(subreddit.mod_log, params, lambda log_id: {'kind': "modaction", 'data': reddit.log_items[log_id]})
+
+
+@route("GET", r"/r/([^/]+)/about/(modqueue|unmoderated)")
+def get_mod_queue(reddit, account, params, name, queue_name):
+	subreddit = subreddit_by_name(reddit, name)
+	queue = subreddit.modqueue if queue_name == "modqueue" else subreddit.unmoderated
+	keys = sorted(queue, key=lambda fullname: reddit.things[fullname]['created_utc'])
+	return 200, reddit.page(keys, params, reddit.thing, use_positions=False)
+
+
+@route("GET", r"/r/([^/]+)/about/contributors")
+def get_contributors(reddit, account, params, name):
+	subreddit = subreddit_by_name(reddit, name)
+	return 200, listing([
+		{'name': user, 'id': f"t2_{base36(zlib.crc32(user.encode()))}", 'rel_id': f"rb_{index}", 'date': 1600000000}
+		for index, user in enumerate(subreddit.contributors)])
+
+
+@route("GET", r"/r/([^/]+)/comments")
+def get_comments(reddit, account, params, name):
+	return 200, reddit.page(subreddit_by_name(reddit, name).comments, params, reddit.thing)
+
+
+@route("GET", r"/r/([^/]+)/new")
+def get_new(reddit, account, params, name):
+	return 200, reddit.page(subreddit_by_name(reddit, name).submissions, params, reddit.thing)
+
+
+@route("GET", r"(?:/r/[^/]+)?/comments/([^/]+)(?:/[^/]*)?(?:/([^/]+))?")
+def get_submission(reddit, account, params, submission_id, comment_id):
+	submission = reddit.thing(f"t3_{submission_id}")
+	if comment_id is not None:
+		comments = [reddit.comment_tree(f"t1_{comment_id}")]
+	else:
+		comments = [reddit.comment_tree(fullname) for fullname in reddit.replies[f"t3_{submission_id}"]]
+	return 200, [listing([submission]), listing(comments)]
+
+
+@route("GET", r"/api/info")
+def get_info(reddit, account, params):
+	fullnames = [fullname for fullname in params.get('id', "").split(",") if fullname in reddit.things]
+	return 200, listing([reddit.thing(fullname) for fullname in fullnames[:100]])
+
+
+@route("GET", r"/r/([^/]+)/wiki/revisions/([^/]+)")
+def get_wiki_revisions(reddit, account, params, name, page):
+	revisions = subreddit_by_name(reddit, name).wiki[page]
+	return 200, reddit.page(
+		list(range(len(revisions))), params,
+		lambda index: {
+			'id': revisions[index]['id'], 'author': {'kind': "t2", 'data': {'name': revisions[index]['author']}},
+			'timestamp': revisions[index]['timestamp'], 'reason': revisions[index]['reason'], 'page': page, 'hidden': False},
+		use_positions=False)
+
+
+@route("GET", r"/r/([^/]+)/wiki/([^/]+)")
+def get_wiki(reddit, account, params, name, page):
+	revision = subreddit_by_name(reddit, name).wiki[page][-1]
+	return 200, {'kind': "wikipage", 'data': {
+		'content_md': revision['content'], 'content_html': "", 'may_revise': True, 'reason': revision['reason'],
+		'revision_id': revision['id'], 'revision_date': revision['timestamp'],
+		'revision_by': {'kind': "t2", 'data': {'name': revision['author']}}}}
+
+
+@route("POST", r"/r/([^/]+)/api/wiki/edit")
+def post_wiki_edit(reddit, account, params, name):
+	subreddit = subreddit_by_name(reddit, name)
+	revisions = subreddit.wiki[params['page']]
+	if params.get('previous') and revisions and revisions[-1]['id'] != params['previous']:
+		return 409, {'message': "Conflict", 'error': 409}
+	reddit.save_wiki(subreddit, params['page'], params['content'], account, params.get('reason'))
+	reddit.add_mod_action(subreddit, account, "wikirevise", details=f"Page {params['page']} edited")
+	return 200, {}
+
+
+@route("GET", r"/api/mod/conversations")
+def get_conversations(reddit, account, params):
+	conversations = []
+	for name in params.get('entity', ",".join(reddit.subreddits)).split(","):
+		subreddit = subreddit_by_name(reddit, name)
+		for conversation in subreddit.conversations.values():
+			if conversation['state'] == params.get('state', "all"):
+				conversations.append((subreddit, conversation))
+	conversations.sort(key=lambda item: item[1]['last_updated'], reverse=True)
+	if params.get('after'):
+		ids = [conversation['id'] for _, conversation in conversations]
+		conversations = conversations[ids.index(params['after']) + 1:] if params['after'] in ids else []
+	result = {'conversations': {}, 'conversationIds': [], 'messages': {}, 'viewerId': "t2_fake"}
+	for subreddit, conversation in conversations[:min(int(params.get('limit', 25)), 100)]:
+		data, messages = reddit.render_conversation(subreddit, conversation)
+		result['conversations'][data['id']] = data
+		result['conversationIds'].append(data['id'])
+		result['messages'].update(messages)
+	return 200, result
+
+
+@route("POST", r"/api/mod/conversations")
+def post_conversation(reddit, account, params):
+	subreddit = subreddit_by_name(reddit, params['srName'])
+	conversation = reddit.add_conversation(subreddit, params['to'], params['body'], sender=account)
+	conversation['subject'] = params.get('subject', conversation['subject'])
+	return 200, reddit.fetched_conversation(subreddit, conversation)
+
+
+@route("GET", r"/api/mod/conversations/(?!unread|subreddits)([^/]+)")
+def get_conversation(reddit, account, params, conversation_id):
+	subreddit, conversation = reddit.find_conversation(conversation_id)
+	if conversation is None:
+		return 404, {'message': "Not Found", 'error': 404}
+	return 200, reddit.fetched_conversation(subreddit, conversation)
+
+
+@route("POST", r"/api/mod/conversations/(?!read|unread|bulk)([^/]+)")
+def post_conversation_reply(reddit, account, params, conversation_id):
+	subreddit, conversation = reddit.find_conversation(conversation_id)
+	if conversation is None:
+		return 404, {'message': "Not Found", 'error': 404}
+	reddit.add_message(subreddit, conversation, account, params['body'], internal=params.get('isInternal') == "True")
+	return 200, reddit.fetched_conversation(subreddit, conversation)
+
+
+@route("POST", r"/api/mod/conversations/([^/]+)/(archive|unarchive|highlight)")
+def post_conversation_state(reddit, account, params, conversation_id, action):
+	subreddit, conversation = reddit.find_conversation(conversation_id)
+	if conversation is None:
+		return 404, {'message': "Not Found", 'error': 404}
+	if action == "archive":
+		conversation['state'] = "archived"
+	elif action == "unarchive":
+		conversation['state'] = "all"
+	else:
+		conversation['is_highlighted'] = True
+	return 200, reddit.fetched_conversation(subreddit, conversation)
+
+
+@route("DELETE", r"/api/mod/conversations/([^/]+)/highlight")
+def delete_conversation_highlight(reddit, account, params, conversation_id):
+	subreddit, conversation = reddit.find_conversation(conversation_id)
+	if conversation is None:
+		return 404, {'message': "Not Found", 'error': 404}
+	conversation['is_highlighted'] = False
+	return 200, reddit.fetched_conversation(subreddit, conversation)
+
+
+@route("GET", r"/message/unread")
+def get_unread(reddit, account, params):
+	return 200, listing([])
+
+
+@route("GET", r"/user/([^/]+)/about")
+def get_user_about(reddit, account, params, name):
+	return 200, {'kind': "t2", 'data': {
+		'name': name, 'id': base36(zlib.crc32(name.encode())), 'created_utc': 1500000000, 'link_karma': 10, 'comment_karma': 100}}
+
+
+@route("GET", r"/user/([^/]+)/comments")
+def get_user_comments(reddit, account, params, name):
+	if name in reddit.private_users and account not in MOD_ACCOUNTS:
+		return 200, listing([])
+	return 200, reddit.page(reddit.user_comments[name], params, reddit.thing, use_positions=False)
+
+
+@route("POST", r"/api/(remove|approve)")
+def post_moderate(reddit, account, params, action):
+	reddit.moderate(reddit.subreddit_for(params['id']), params['id'], account, action)
+	return 200, {}
+
+
+@route("POST", r"/api/(lock|unlock)")
+def post_lock(reddit, account, params, action):
+	reddit.things[params['id']]['locked'] = action == "lock"
+	reddit.add_mod_action(reddit.subreddit_for(params['id']), account, action, params['id'])
+	return 200, {}
+
+
+@route("POST", r"/r/([^/]+)/api/(?:flair|selectflair)")
+def post_flair(reddit, account, params, name):
+	fullname = params['link']
+	reddit.things[fullname]['link_flair_text'] = params.get('text')
+	reddit.add_mod_action(subreddit_by_name(reddit, name), account, "editflair", fullname)
+	return 200, {'success': True}
+
+
+@route("POST", r"/api/distinguish/?(\w*)")
+def post_distinguish(reddit, account, params, how):
+	thing = reddit.things[params['id']]
+	how = how or params.get('how', "yes")
+	thing['distinguished'] = "moderator" if how == "yes" else None
+	thing['stickied'] = params.get('sticky') == "True"
+	reddit.add_mod_action(reddit.subreddit_for(params['id']), account, "distinguish", params['id'])
+	return 200, {'json': {'errors': [], 'data': {'things': [reddit.thing(params['id'])]}}}
+
+
+@route("POST", r"/api/comment")
+def post_comment(reddit, account, params):
+	subreddit = reddit.subreddit_for(params['thing_id'])
+	fullname = reddit.add_comment(subreddit, author=account, parent=params['thing_id'], body=params.get('text'))
+	return 200, {'json': {'errors': [], 'data': {'things': [reddit.thing(fullname)]}}}
+
+
+@route("POST", r"/api/report")
+def post_report(reddit, account, params):
+	thing = reddit.things[params['thing_id']]
+	thing['user_reports'].append([params.get('reason', "report"), 1, False, False])
+	reddit.subreddit_for(params['thing_id']).modqueue[params['thing_id']] = True
+	return 200, {}
+
+
+@route("POST", r"/r/([^/]+)/api/(friend|unfriend)")
+def post_friend(reddit, account, params, name, action):
+	subreddit = subreddit_by_name(reddit, name)
+	if params.get('type') == "banned":
+		if action == "friend":
+			subreddit.banned.add(params['name'])
+			reddit.add_mod_action(subreddit, account, "banuser", details=f"{params.get('duration', 'permanent')} days")
+		else:
+			subreddit.banned.discard(params['name'])
+			reddit.add_mod_action(subreddit, account, "unbanuser")
+	return 200, {'json': {'errors': []}}
+
+
+@route("POST", r"/api/(?:compose|read_message|read_all_messages|ignore_reports|unignore_reports)")
+@route("POST", r"/api/mod/conversations/(?:read|unread|bulk/read)")
+def post_ignored(reddit, account, params):
+	return 200, {}
+
+
+def log_stats(reddit, interval):
+	last_total = 0
+	while True:
+		time.sleep(interval)
+		with reddit.lock:
+			total = sum(reddit.requests.values())
+			top = sorted(reddit.requests.items(), key=lambda item: item[1], reverse=True)[:8]
+			queues = ", ".join(
+				f"r/{subreddit.name} {len(subreddit.modqueue)} queued {len(subreddit.comments)} comments"
+				for subreddit in reddit.subreddits.values())
+		log.info(f"{(total - last_total) / interval:.1f} requests a second, {total} total, {reddit.limited} rate limited : {queues}")
+		log.info(" : ".join(f"{endpoint} {count}" for endpoint, count in top))
+		last_total = total
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Fake reddit api with a synthetic workload")
+	parser.add_argument("--port", help="Port to listen on", type=int, default=8080)
+	parser.add_argument("--subreddits", help="Comma separated subreddits to serve", default="CompetitiveOverwatch,bayarea")
+	parser.add_argument("--users", help="Size of the pool of users creating content", type=int, default=20000)
+	parser.add_argument("--private-share", help="Share of users with private profiles", type=float, default=0.05)
+	parser.add_argument("--comments-per-second", help="New comments per subreddit", type=float, default=5)
+	parser.add_argument("--reply-share", help="Share of comments that reply to another comment", type=float, default=0.4)
+	parser.add_argument("--submissions-per-minute", help="New submissions per subreddit", type=float, default=2)
+	parser.add_argument("--reports-per-minute", help="New reports per subreddit", type=float, default=5)
+	parser.add_argument("--modmail-per-minute", help="New modmail messages per subreddit", type=float, default=1)
+	parser.add_argument("--actions-per-minute", help="Actions by other moderators per subreddit", type=float, default=5)
+	parser.add_argument("--modqueue", help="Items in each modqueue at startup", type=int, default=50)
+	parser.add_argument("--initial-submissions", help="Submissions in each subreddit at startup", type=int, default=200)
+	parser.add_argument("--initial-comments", help="Comments in each subreddit at startup", type=int, default=2000)
+	parser.add_argument("--initial-modmail", help="Modmail conversations in each subreddit at startup", type=int, default=50)
+	parser.add_argument("--ratelimit", help="Requests allowed per account in each window", type=int, default=1000)
+	parser.add_argument("--ratelimit-window", help="Length of the rate limit window in seconds", type=int, default=600)
+	parser.add_argument("--latency", help="Seconds to wait before answering each request", type=float, default=0)
+	parser.add_argument("--stats-seconds", help="How often to log request stats", type=int, default=60)
+	parser.add_argument("--seed", help="Random seed for the workload", type=int, default=None)
+	args = parser.parse_args()
+
+	random.seed(args.seed)
+	reddit = FakeReddit(args)
+	reddit.seed()
+	FakeRedditHandler.reddit = reddit
+	threading.Thread(target=reddit.generate, name="workload", daemon=True).start()
+	threading.Thread(target=log_stats, args=(reddit, args.stats_seconds), name="stats", daemon=True).start()
+
+	server = ThreadingHTTPServer(("127.0.0.1", args.port), FakeRedditHandler)
+	server.daemon_threads = True
+	log.info(f"Serving fake reddit on http://127.0.0.1:{args.port}")
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		log.info("Shutting down")
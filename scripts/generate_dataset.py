@@ -0,0 +1,165 @@
+import argparse
+import itertools
+import os
+import random
+import time
+from datetime import datetime, timedelta
+import discord_logging
+from sqlalchemy import insert, text
+
+log = discord_logging.init_logging()
+
+import static
+from database import Comment, User, Submission, LogItem, Database
+
+# fills a new database with a synthetic history shaped like ours, so queries can be checked at sizes we don't have yet.
+# a few heavy posters write a big share of the comments, most comments land in a thread's first few hours and a few
+# threads get most of the comments
+
+SUBREDDIT_ID = 2
+LOG_SUBREDDITS = ["bayarea", "CompetitiveOverwatch"]
+ITEM_ACTIONS = ["removecomment", "approvecomment", "removelink", "approvelink"]
+OTHER_ACTIONS = ["editflair", "banuser", "wikirevise", "distinguish", "sticky"]
+OPPOSITE_ACTIONS = {"removecomment": "approvecomment", "approvecomment": "removecomment", "removelink": "approvelink", "approvelink": "removelink"}
+
+
+def base36(number):
+	digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+	result = ""
+	while number:
+		number, remainder = divmod(number, 36)
+		result = digits[remainder] + result
+	return result or "0"
+
+
+def zipf_weights(count, exponent):
+	return list(itertools.accumulate(1 / rank ** exponent for rank in range(1, count + 1)))
+
+
+def karma_for(created, now):
+	# karma is only backfilled a day after posting, and a few older items never got it
+	if created > now - timedelta(days=1) or random.random() < 0.01:
+		return None
+	return int(random.paretovariate(1.2)) - random.randint(0, 2)
+
+
+def insert_batches(database, table, rows, batch_size=20000):
+	count = 0
+	batch = []
+	for row in rows:
+		batch.append(row)
+		if len(batch) >= batch_size:
+			database.session.execute(insert(table), batch)
+			count += len(batch)
+			batch = []
+	if batch:
+		database.session.execute(insert(table), batch)
+		count += len(batch)
+	return count
+
+
+def generate(location, comments, users=None, days=400, log_share=0.25, author_exponent=1.1, seed=0):
+	random.seed(seed)
+	now = datetime.utcnow()
+	count_users = users or max(comments // 15, 100)
+	count_submissions = max(comments // 40, 10)
+	count_log = int(comments * log_share)
+	start_time = time.perf_counter()
+
+	database = Database(location)
+	connection = database.session.connection()
+	connection.execute(text("pragma synchronous = off"))
+	connection.execute(text("pragma journal_mode = memory"))
+
+	# user ids are the popularity rank, so the heaviest posters are the lowest ids
+	insert_batches(database, User.__table__, (
+		{'id': user_id, 'name': f"synthetic_user_{user_id}", 'is_deleted': random.random() < 0.02, 'is_private': random.random() < 0.03}
+		for user_id in range(1, count_users + 1)))
+	author_weights = zipf_weights(count_users, author_exponent)
+	user_ids = range(1, count_users + 1)
+
+	submission_created = []
+	submission_rows = []
+	for submission_id, author_id in enumerate(random.choices(user_ids, cum_weights=author_weights, k=count_submissions), start=1):
+		created = now - timedelta(seconds=random.random() * days * 86400)
+		submission_created.append(created)
+		submission_rows.append({
+			'id': submission_id, 'submission_id': base36(36 ** 5 + submission_id), 'is_restricted': random.random() < 0.1,
+			'created': created, 'is_notified': False, 'author_id': author_id, 'karma': karma_for(created, now),
+			'is_removed': random.random() < 0.08, 'is_deleted': random.random() < 0.03, 'subreddit_id': SUBREDDIT_ID})
+	insert_batches(database, Submission.__table__, submission_rows)
+	log.info(f"Inserted {count_users} users and {count_submissions} submissions")
+
+	# thread popularity is independent of the posting time, so shuffle which submissions get the heavy weights
+	thread_order = list(range(1, count_submissions + 1))
+	random.shuffle(thread_order)
+	thread_weights = zipf_weights(count_submissions, 0.9)
+	comment_targets = []
+
+	def comment_rows():
+		authors = random.choices(user_ids, cum_weights=author_weights, k=comments)
+		threads = random.choices(thread_order, cum_weights=thread_weights, k=comments)
+		for comment_id in range(1, comments + 1):
+			submission_id = threads[comment_id - 1]
+			# most of a thread's comments arrive in its first few hours
+			created = min(submission_created[submission_id - 1] + timedelta(seconds=random.expovariate(1 / 7200)), now)
+			if comment_id % 4 == 0:
+				comment_targets.append((f"t1_{base36(36 ** 6 + comment_id)}", created))
+			yield {
+				'id': comment_id, 'comment_id': base36(36 ** 6 + comment_id), 'author_id': authors[comment_id - 1],
+				'submission_id': submission_id, 'created': created, 'karma': karma_for(created, now),
+				'is_removed': random.random() < 0.05, 'is_deleted': random.random() < 0.03,
+				'is_author_restricted': random.random() < 0.02, 'subreddit_id': SUBREDDIT_ID}
+			if comment_id % 1000000 == 0:
+				log.info(f"Inserted {comment_id}/{comments} comments")
+	insert_batches(database, Comment.__table__, comment_rows())
+	log.info(f"Inserted {comments} comments")
+
+	targets = comment_targets + [(f"t3_{row['submission_id']}", row['created']) for row in submission_rows]
+	moderators = {
+		"bayarea": list(static.BAYAREA_MODERATORS) + ["AutoModerator", "CustomModBot"],
+		"CompetitiveOverwatch": list(static.COMPOW_MODERATORS) + ["AutoModerator", "CustomModBot"],
+	}
+
+	def log_rows():
+		log_id = 0
+		while log_id < count_log:
+			subreddit = random.choice(LOG_SUBREDDITS)
+			fullname, target_created = random.choice(targets)
+			created = min(target_created + timedelta(seconds=random.expovariate(1 / 1800)), now)
+			mod = random.choice(moderators[subreddit])
+			action = random.choice(ITEM_ACTIONS) if random.random() < 0.8 else random.choice(OTHER_ACTIONS)
+			actions = [(mod, action, created)]
+			# occasionally a second moderator reverses the first one shortly after
+			if action in OPPOSITE_ACTIONS and random.random() < 0.02:
+				actions.append((random.choice(moderators[subreddit]), OPPOSITE_ACTIONS[action], min(created + timedelta(seconds=random.randint(10, 3000)), now)))
+			for mod, action, created in actions:
+				log_id += 1
+				yield {
+					'id': f"ModAction_{log_id:012d}", 'created': created, 'mod': mod, 'action': action, 'details': None,
+					'target_author': f"synthetic_user_{random.randint(1, count_users)}", 'target_fullname': fullname,
+					'target_permalink': f"/r/{subreddit}/comments/{fullname[3:]}/", 'target_title': None, 'target_body': None,
+					'description': None, 'subreddit': subreddit}
+	inserted_log = insert_batches(database, LogItem.__table__, log_rows())
+	log.info(f"Inserted {inserted_log} log items")
+
+	database.rebuild_user_history()
+	database.session.execute(text("analyze"))
+	database.commit()
+	log.info(f"Generated {location} in {time.perf_counter() - start_time:.2f} seconds")
+	return database
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Generate a synthetic database for benchmarking")
+	parser.add_argument("location", help="Database file to create")
+	parser.add_argument("--comments", help="Number of comments, everything else is scaled from this", type=int, default=100000)
+	parser.add_argument("--users", help="Number of users, defaults to one for every 15 comments", type=int, default=None)
+	parser.add_argument("--days", help="Days of history", type=int, default=400)
+	parser.add_argument("--seed", help="Random seed", type=int, default=0)
+	args = parser.parse_args()
+
+	if os.path.exists(args.location):
+		log.error(f"{args.location} already exists")
+	else:
+		generate(args.location, args.comments, users=args.users, days=args.days, seed=args.seed).close()
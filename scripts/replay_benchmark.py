@@ -0,0 +1,98 @@
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from collections import defaultdict
+import discord_logging
+
+log = discord_logging.init_logging()
+
+import main
+import static
+import counters
+import notifications
+from database import Database
+from scheduler import Scheduler
+from recording import ReplaySession
+from reddit_requestor import CountingRequestor, LockedReddit
+
+# replays a file recorded with `main.py --record` through the real pipeline functions against a scratch database.
+# run it from the src folder with the same praw.ini as the recorded run, so the subreddits get the same config
+
+
+def metric_totals(metric, suffix, label):
+	totals = defaultdict(float)
+	for collected in metric.collect():
+		for sample in collected.samples:
+			if sample.name.endswith(suffix):
+				totals[sample.labels[label] if label else "total"] += sample.value
+	return totals
+
+
+def replay_login(session):
+	instances = {}
+	for username in ['CustomModBot', 'Watchful1', 'Watchful1BotTest']:
+		instances[username] = LockedReddit(
+			client_id="replay", client_secret="replay", username=username, password="replay", user_agent=static.USER_AGENT,
+			requestor_class=CountingRequestor, requestor_kwargs={'session': session}, check_for_updates=False)
+	return instances
+
+
+async def replay(recording, database, loops):
+	session = ReplaySession(recording)
+	instances = await asyncio.to_thread(replay_login, session)
+	praw_file = discord_logging.get_config()
+
+	scheduler = Scheduler("replay", after_task=database.commit)
+	main.add_comp_ow_tasks(scheduler, await asyncio.to_thread(main.build_comp_ow, instances, praw_file), database)
+	main.add_bay_area_tasks(scheduler, await asyncio.to_thread(main.build_bay_area, instances, praw_file), database)
+
+	loop_times = []
+	for loop in range(loops):
+		for task in scheduler.tasks:
+			task.next_run = 0
+		start_time = time.perf_counter()
+		await scheduler.run_pass()
+		loop_times.append(time.perf_counter() - start_time)
+	return session, loop_times
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Replay a recorded loop against a scratch database")
+	parser.add_argument("recording", help="File written by main.py --record")
+	parser.add_argument("--loops", help="How many times to run every task", type=int, default=3)
+	parser.add_argument("--database", help="Database to run against, defaults to a new empty one that's deleted afterwards")
+	args = parser.parse_args()
+
+	notifications.enabled = False
+	location = args.database
+	if location is None:
+		location = os.path.join(tempfile.mkdtemp(), "replay.db")
+	database = Database(location)
+
+	session, loop_times = asyncio.run(replay(args.recording, database, args.loops))
+
+	for loop, loop_time in enumerate(loop_times):
+		log.info(f"Loop {loop + 1}: {loop_time:.2f} seconds")
+	log.info(f"Average loop: {sum(loop_times) / len(loop_times):.2f} seconds")
+
+	stage_times = metric_totals(counters.stage_time, "_sum", 'stage')
+	stage_counts = metric_totals(counters.stage_time, "_count", 'stage')
+	sql_counts = metric_totals(counters.sql_queries, "_total", 'stage')
+	sql_times = metric_totals(counters.sql_time, "_total", 'stage')
+	api_counts = metric_totals(counters.reddit_requests, "_total", 'stage')
+	log.info(f"{'stage':<34}{'runs':>6}{'seconds':>10}{'queries':>9}{'sql sec':>9}{'api':>6}")
+	for stage_name in sorted(stage_times, key=lambda name: stage_times[name], reverse=True):
+		log.info(
+			f"{stage_name:<34}{stage_counts[stage_name]:>6.0f}{stage_times[stage_name]:>10.2f}"
+			f"{sql_counts[stage_name]:>9.0f}{sql_times[stage_name]:>9.2f}{api_counts[stage_name]:>6.0f}")
+	log.info(
+		f"Total: {sum(sql_counts.values()):.0f} queries, {sum(api_counts.values()):.0f} api calls, "
+		f"{sum(session.missing.values())} requests that weren't in the recording")
+	for key, count in sorted(session.missing.items(), key=lambda item: item[1], reverse=True)[:10]:
+		log.info(f"Not recorded: {count} x {key}")
+
+	database.close()
+	if args.database is None:
+		os.remove(location)
@@ -0,0 +1,33 @@
+import argparse
+import os
+import discord_logging
+
+log = discord_logging.init_logging()
+
+import backup_store
+from database import integrity_check
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="List the stored backups, or rebuild a database file from one of them")
+	parser.add_argument("name", nargs='?', help="Backup to restore, or latest. Lists the backups if left out")
+	parser.add_argument("output", nargs='?', help="Database file to write, defaults to the backup name")
+	parser.add_argument("--folder", help="Backup folder", default="backup")
+	args = parser.parse_args()
+
+	names = backup_store.list_snapshots(args.folder)
+	if args.name is None:
+		for name in names:
+			manifest = backup_store.load_snapshot(args.folder, name)
+			log.info(f"{name} : {manifest['size'] / 1024 / 1024:.1f} mb in {len(manifest['chunks'])} chunks")
+		log.info(f"{len(names)} backups")
+	else:
+		name = names[-1] if args.name == "latest" and len(names) else args.name
+		output = args.output or f"{name}.db"
+		if name not in names:
+			log.error(f"Backup {name} doesn't exist")
+		elif os.path.exists(output):
+			log.error(f"{output} already exists")
+		else:
+			backup_store.restore(args.folder, name, output)
+			log.info(f"Integrity check: {integrity_check(output)}")
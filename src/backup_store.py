@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import zlib
+from datetime import datetime
+import discord_logging
+
+log = discord_logging.get_logger()
+
+# backups are split into fixed size chunks that are stored once by their hash, so each day only writes the chunks that
+# changed. a snapshot is a manifest listing its chunks in order
+chunk_size = 256 * 1024
+# how many of the most recent days, weeks and months keep their newest snapshot
+retention = {'daily': 7, 'weekly': 4, 'monthly': 12}
+SNAPSHOT_FORMAT = "%Y-%m-%d_%H-%M"
+PERIODS = {
+	'daily': lambda created: created.date(),
+	'weekly': lambda created: tuple(created.isocalendar())[:2],
+	'monthly': lambda created: (created.year, created.month),
+}
+
+
+def chunk_path(folder, chunk_hash):
+	return os.path.join(folder, "chunks", chunk_hash[:2], chunk_hash)
+
+
+def snapshot_path(folder, name):
+	return os.path.join(folder, "snapshots", name + ".json")
+
+
+def write_atomic(location, data):
+	os.makedirs(os.path.dirname(location), exist_ok=True)
+	with open(location + ".partial", 'wb') as handle:
+		handle.write(data)
+	os.replace(location + ".partial", location)
+
+
+def store(database_location, folder, name):
+	chunks = []
+	new_chunks = 0
+	written = 0
+	size = 0
+	with open(database_location, 'rb') as handle:
+		while True:
+			chunk = handle.read(chunk_size)
+			if not chunk:
+				break
+			size += len(chunk)
+			chunk_hash = hashlib.sha256(chunk).hexdigest()
+			chunks.append(chunk_hash)
+			location = chunk_path(folder, chunk_hash)
+			if not os.path.exists(location):
+				compressed = zlib.compress(chunk)
+				write_atomic(location, compressed)
+				new_chunks += 1
+				written += len(compressed)
+
+	manifest = {'name': name, 'created': datetime.utcnow().isoformat(), 'size': size, 'chunk_size': chunk_size, 'chunks': chunks}
+	write_atomic(snapshot_path(folder, name), json.dumps(manifest).encode())
+	log.info(f"Stored backup {name}: {new_chunks}/{len(chunks)} chunks were new, wrote {written / 1024 / 1024:.1f} of {size / 1024 / 1024:.1f} mb")
+	return manifest
+
+
+def list_snapshots(folder):
+	snapshot_folder = os.path.join(folder, "snapshots")
+	if not os.path.exists(snapshot_folder):
+		return []
+	return sorted(file_name[:-5] for file_name in os.listdir(snapshot_folder) if file_name.endswith(".json"))
+
+
+def list_legacy_backups(folder):
+	# whole database copies from before the chunk store, named like the snapshots
+	if not os.path.exists(folder):
+		return []
+	names = []
+	for file_name in os.listdir(folder):
+		if file_name.endswith(".db"):
+			try:
+				datetime.strptime(file_name[:-3], SNAPSHOT_FORMAT)
+			except ValueError:
+				continue
+			names.append(file_name[:-3])
+	return sorted(names)
+
+
+def load_snapshot(folder, name):
+	with open(snapshot_path(folder, name), 'r') as handle:
+		return json.load(handle)
+
+
+def snapshots_to_keep(names, retention_counts):
+	# the newest snapshot always stays, then the newest one in each of the most recent periods
+	keep = set(names[-1:])
+	for period, count in retention_counts.items():
+		seen = set()
+		for name in sorted(names, reverse=True):
+			key = PERIODS[period](datetime.strptime(name, SNAPSHOT_FORMAT))
+			if key not in seen:
+				if len(seen) >= count:
+					break
+				seen.add(key)
+				keep.add(name)
+	return keep
+
+
+def rotate(folder, retention_counts=None):
+	names = list_snapshots(folder)
+	# old style backups share the retention with the snapshots, so they're only kept while they fill a period nothing
+	# newer covers
+	legacy_names = list_legacy_backups(folder)
+	keep = snapshots_to_keep(sorted(set(names) | set(legacy_names)), retention_counts or retention)
+	for name in names:
+		if name not in keep:
+			os.remove(snapshot_path(folder, name))
+	removed_legacy = 0
+	for name in legacy_names:
+		if name not in keep:
+			os.remove(os.path.join(folder, name + ".db"))
+			removed_legacy += 1
+
+	# chunks no remaining snapshot uses, including partial writes from an interrupted backup
+	referenced = set()
+	for name in keep:
+		if name in names:
+			referenced.update(load_snapshot(folder, name)['chunks'])
+	removed = 0
+	kept_bytes = 0
+	for directory, _, file_names in os.walk(os.path.join(folder, "chunks")):
+		for file_name in file_names:
+			location = os.path.join(directory, file_name)
+			if file_name in referenced:
+				kept_bytes += os.path.getsize(location)
+			else:
+				os.remove(location)
+				removed += 1
+	log.info(
+		f"Kept {len(keep)}/{len(names) + len(legacy_names)} backups, removed {removed_legacy} old style backups and {removed} "
+		f"unused chunks, store is {kept_bytes / 1024 / 1024:.1f} mb")
+
+
+def restore(folder, name, output_location):
+	manifest = load_snapshot(folder, name)
+	with open(output_location + ".partial", 'wb') as handle:
+		for chunk_hash in manifest['chunks']:
+			with open(chunk_path(folder, chunk_hash), 'rb') as chunk_file:
+				chunk = zlib.decompress(chunk_file.read())
+			if hashlib.sha256(chunk).hexdigest() != chunk_hash:
+				raise ValueError(f"Chunk {chunk_hash} of backup {name} is corrupt")
+			handle.write(chunk)
+	os.replace(output_location + ".partial", output_location)
+	log.info(f"Restored backup {name} to {output_location}, {manifest['size'] / 1024 / 1024:.1f} mb")
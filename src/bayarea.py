@@ -5,16 +5,22 @@ import traceback
 
 import prawcore.exceptions
 from praw.models import Message
-from sqlalchemy.sql import func
 from datetime import datetime, timedelta
+from collections import defaultdict
 
 log = discord_logging.get_logger()
 
 import counters
+import stages
 import utils
+import budget
+import notifications
 import static
 from database import Comment, User, Submission
 
+# the author might have a private profile, but there wasn't enough api budget left to check
+PROFILE_UNCHECKED = "private profile not checked"
+
 
 def filter_recent_posts(subreddit):
 	for submission in subreddit.sub_object.new(limit=100):
@@ -36,23 +42,19 @@ def filter_recent_posts(subreddit):
 			submission.mod.remove()
 
 
+@stages.timed
 def get_comments_for_thread(subreddit, database, thread_id):
 	comments = database.session.query(Comment) \
 		.join(Submission) \
 		.filter(Submission.submission_id == thread_id) \
 		.all()
 
-	author_dict = {}
+	author_dict = authors_comment_restricted(subreddit, database, {comment.author for comment in comments})
 	good_comments = []
 	bad_comments_dict = {}
 	fullnames = []
 	for comment in comments:
-		if comment.author.name in author_dict:
-			author_result = author_dict[comment.author.name]
-		else:
-			author_result = author_comment_restricted(subreddit, database, comment.author)
-			author_dict[comment.author.name] = author_result
-
+		author_result = author_dict[comment.author.name]
 		if author_result is None or comment.author.name in static.WHITELISTED_ACCOUNTS:
 			good_comments.append((comment, "good"))
 		else:
@@ -61,7 +63,7 @@ def get_comments_for_thread(subreddit, database, thread_id):
 
 	bad_comments = []
 	try:
-		for comment in subreddit.reddit.info(fullnames):
+		for comment in subreddit.read_pool.info(fullnames):
 			if comment.score < 10:
 				bad_comments.append(bad_comments_dict[comment.id])
 			else:
@@ -72,11 +74,14 @@ def get_comments_for_thread(subreddit, database, thread_id):
 	return good_comments, bad_comments
 
 
-def update_profile_private(db_author, mod_reddit, non_mod_reddit, force_check=False, save_time=True):
+def update_profile_private(db_author, mod_reddit, non_mod_reddit, force_check=False, save_time=True, check_budget=True):
+	# returns None if the profile needed checking and the budget was too low to do it
 	if non_mod_reddit is None:
 		return False
 	if not force_check and db_author.private_checked is not None and db_author.private_checked > datetime.utcnow() - timedelta(days=1):
 		return db_author.is_private
+	if not force_check and check_budget and not budget.request(non_mod_reddit, 2, "private_profile"):
+		return None
 
 	log.info(f"Checking for private profile for u/{db_author.name}")
 	try:
@@ -100,57 +105,60 @@ def update_profile_private(db_author, mod_reddit, non_mod_reddit, force_check=Fa
 	return False
 
 
-def author_comment_restricted(subreddit, database, db_author, save_profile_time=True):
-	if db_author.name in static.WHITELISTED_ACCOUNTS:
-		return None
-	if len(subreddit.approved) and db_author.name in subreddit.approved:
-		log.info(f"u/{db_author.name} is approved, permitting content")
-		return None
+def author_comment_restricted(subreddit, database, db_author, save_profile_time=True, check_budget=True):
+	return authors_comment_restricted(subreddit, database, [db_author], save_profile_time, check_budget)[db_author.name]
+
 
+def authors_comment_restricted(subreddit, database, db_authors, save_profile_time=True, check_budget=True):
+	results = {}
+	remaining_authors = []
+	for db_author in db_authors:
+		if db_author.name in static.WHITELISTED_ACCOUNTS:
+			results[db_author.name] = None
+		elif len(subreddit.approved) and db_author.name in subreddit.approved:
+			log.info(f"u/{db_author.name} is approved, permitting content")
+			results[db_author.name] = None
+		else:
+			remaining_authors.append(db_author)
+	if not len(remaining_authors):
+		return results
+
+	if any(db_author.id is None for db_author in remaining_authors):
+		database.session.flush()
 	min_comment_date = datetime.utcnow() - timedelta(days=subreddit.restricted['comment_days'])
-	count_comments = database.session.query(Comment)\
-		.filter(Comment.subreddit_id == subreddit.sub_id)\
-		.filter(Comment.author == db_author)\
-		.filter(Comment.is_removed == False)\
-		.filter(Comment.created < min_comment_date)\
-		.count()
-	count_submissions = database.session.query(Submission)\
-		.filter(Submission.subreddit_id == subreddit.sub_id)\
-		.filter(Submission.author == db_author)\
-		.filter(Submission.is_removed == False)\
-		.filter(Submission.created < min_comment_date)\
-		.count()
-	if count_comments + count_submissions < subreddit.restricted['comments']:
-		return f"comments {count_comments} + {count_submissions} = {count_comments + count_submissions} < {subreddit.restricted['comments']}"
-
-	count_comment_karma = database.session.query(func.sum(Comment.karma).label('karma'))\
-		.filter(Comment.subreddit_id == subreddit.sub_id)\
-		.filter(Comment.author == db_author)\
-		.filter(Comment.created < min_comment_date)\
-		.scalar()
-	if count_comment_karma is None:
-		count_comment_karma = 0
-	count_submission_karma = database.session.query(func.sum(Submission.karma).label('karma'))\
-		.filter(Submission.subreddit_id == subreddit.sub_id)\
-		.filter(Submission.author == db_author)\
-		.filter(Submission.created < min_comment_date)\
-		.scalar()
-	if count_submission_karma is None:
-		count_submission_karma = 0
-	if count_comment_karma + count_submission_karma < subreddit.restricted['karma']:
-		return f"karma {count_comment_karma} + {count_submission_karma} = {count_comment_karma + count_submission_karma} < {subreddit.restricted['karma']}"
-
-	is_private = update_profile_private(db_author, subreddit.reddit, subreddit.non_mod_reddit, save_time=save_profile_time)
-	if is_private:
-		return "private profile"
-
-	return None
-
-
-def action_comment(subreddit, comment, author_result):
+	author_counts = database.get_bulk_user_history(subreddit.sub_id, [db_author.id for db_author in remaining_authors], min_comment_date)
+
+	for db_author in remaining_authors:
+		count_comments, count_submissions, count_comment_karma, count_submission_karma = author_counts[db_author.id]
+		if count_comments + count_submissions < subreddit.restricted['comments']:
+			results[db_author.name] = f"comments {count_comments} + {count_submissions} = {count_comments + count_submissions} < {subreddit.restricted['comments']}"
+		elif count_comment_karma + count_submission_karma < subreddit.restricted['karma']:
+			results[db_author.name] = f"karma {count_comment_karma} + {count_submission_karma} = {count_comment_karma + count_submission_karma} < {subreddit.restricted['karma']}"
+		else:
+			is_private = update_profile_private(
+				db_author, subreddit.reddit, subreddit.non_mod_reddit, save_time=save_profile_time, check_budget=check_budget)
+			if is_private is None:
+				results[db_author.name] = PROFILE_UNCHECKED
+			elif is_private:
+				results[db_author.name] = "private profile"
+			else:
+				results[db_author.name] = None
+
+	return results
+
+
+def action_comment(subreddit, database, comment, author_result):
+	if author_result == PROFILE_UNCHECKED:
+		# hold it until recheck_deferred_comments can check the profile, rather than letting it through. it's kept in the
+		# database so a restart doesn't release it
+		database.add_deferred_comment(comment.comment_id, subreddit.sub_id)
+		log.info(f"Comment {comment.comment_id} by u/{comment.author.name} deferred until the author's profile can be checked")
+		return
 	comment.is_author_restricted = True
 	if subreddit.restricted['action'] == "remove":
 		subreddit.reddit.comment(comment.comment_id).mod.remove()
+		if not comment.is_removed:
+			database.update_user_history(comment.author, subreddit.sub_id, comment.created, comments=-1)
 		comment.is_removed = True
 		log.info(f"Comment {comment.comment_id} by u/{comment.author.name} removed: {author_result}")
 	elif subreddit.restricted['action'] == "report":
@@ -181,6 +189,7 @@ def add_submission(subreddit, database, db_submission, reddit_submission, force_
 			subreddit_id=subreddit.sub_id
 		)
 		database.session.add(db_submission)
+		database.update_user_history(db_user, subreddit.sub_id, db_submission.created, submissions=1)
 		reprocess_submission = flair_restricted
 
 	elif db_submission.is_restricted is not flair_restricted:
@@ -204,7 +213,8 @@ def add_submission(subreddit, database, db_submission, reddit_submission, force_
 				.first()
 			comment_text = None
 			log_reason = None
-			restriction_reason = author_comment_restricted(subreddit, database, db_user, save_profile_time=False)
+			# a one time moderation action that wouldn't be retried, so it isn't held back by the budget
+			restriction_reason = author_comment_restricted(subreddit, database, db_user, save_profile_time=False, check_budget=False)
 			if restriction_reason == "private profile":
 				log_reason = "Private profile."
 				comment_text = \
@@ -259,6 +269,8 @@ def add_submission(subreddit, database, db_submission, reddit_submission, force_
 							top_comment.mod.remove()
 					bot_comment = reddit_submission.reply(comment_text)
 					subreddit.approve_comment(bot_comment, True)
+					if not db_submission.is_removed:
+						database.update_user_history(db_user, subreddit.sub_id, db_submission.created, submissions=-1)
 					db_submission.is_removed = True
 
 				if flair_changed:
@@ -273,10 +285,12 @@ def add_submission(subreddit, database, db_submission, reddit_submission, force_
 					utils.warn_archive(
 						reddit_submission.author,
 						subreddit,
+						database,
 						f"Submission flair changed",
 						warn_reason)
 					# utils.add_usernote(
 					# 	subreddit,
+					# 	database,
 					# 	db_user.name,
 					# 	subreddit.get_account_name(),
 					# 	"spamwarn",
@@ -297,7 +311,7 @@ def add_submission(subreddit, database, db_submission, reddit_submission, force_
 		if len(bad_comments) + len(good_comments) > 0:
 			log.info(f"Reprocessing submission {reddit_submission.id} with {len(good_comments) + len(bad_comments)} comments")
 			for comment, author_result in bad_comments:
-				action_comment(subreddit, comment, author_result)
+				action_comment(subreddit, database, comment, author_result)
 			log.warning(f"Finished submission <https://www.reddit.com{reddit_submission.permalink}>, removed {len(bad_comments)}/{len(good_comments) + len(bad_comments)} comments")
 
 	else:
@@ -314,10 +328,11 @@ def add_submission(subreddit, database, db_submission, reddit_submission, force_
 				f"follows removed restricted [recent submission](<https://www.reddit.com/r/{subreddit.name}/comments/{recent_removed_submission.submission_id}/>)"
 			)
 
-	discord_logging.flush_discord()
+	notifications.flush_discord()
 	return db_submission
 
 
+@stages.timed
 def ingest_submissions(subreddit, database):
 	for submission in subreddit.sub_object.new(limit=25):
 		db_submission = database.session.query(Submission).filter_by(submission_id=submission.id).first()
@@ -325,6 +340,7 @@ def ingest_submissions(subreddit, database):
 			db_submission = add_submission(subreddit, database, None, submission)
 
 
+@stages.timed
 def ingest_comments(subreddit, database):
 	for comment in subreddit.sub_object.comments(limit=None):
 		if database.session.query(Comment).filter_by(comment_id=comment.id).count() > 0:
@@ -351,12 +367,16 @@ def ingest_comments(subreddit, database):
 			created=datetime.utcfromtimestamp(comment.created_utc),
 			subreddit_id=subreddit.sub_id
 		))
+		database.update_user_history(db_user, subreddit.sub_id, db_comment.created, comments=1)
 
 		if db_submission.is_restricted and comment.author.name not in static.WHITELISTED_ACCOUNTS:
 			author_result = author_comment_restricted(subreddit, database, db_user)
-			if author_result is not None:
+			if author_result == PROFILE_UNCHECKED:
+				counters.user_comments.labels(subreddit=subreddit.name, result="deferred").inc()
+				action_comment(subreddit, database, db_comment, author_result)
+			elif author_result is not None:
 				counters.user_comments.labels(subreddit=subreddit.name, result="filtered").inc()
-				action_comment(subreddit, db_comment, author_result)
+				action_comment(subreddit, database, db_comment, author_result)
 			else:
 				counters.user_comments.labels(subreddit=subreddit.name, result="allowed").inc()
 		else:
@@ -372,6 +392,27 @@ def ingest_comments(subreddit, database):
 					db_submission.is_notified = True
 
 
+@stages.timed
+def recheck_deferred_comments(subreddit, database):
+	for deferred_comment in database.get_deferred_comments(subreddit.sub_id):
+		comment_id = deferred_comment.comment_id
+		db_comment = database.session.query(Comment).filter_by(comment_id=comment_id).first()
+		if db_comment is None or db_comment.is_removed:
+			database.session.delete(deferred_comment)
+			continue
+		author_result = author_comment_restricted(subreddit, database, db_comment.author)
+		if author_result == PROFILE_UNCHECKED:
+			break  # still short on budget, try again next run
+		database.session.delete(deferred_comment)
+		if author_result is not None:
+			counters.user_comments.labels(subreddit=subreddit.name, result="filtered").inc()
+			action_comment(subreddit, database, db_comment, author_result)
+		else:
+			counters.user_comments.labels(subreddit=subreddit.name, result="allowed").inc()
+			log.info(f"Deferred comment {comment_id} by u/{db_comment.author.name} allowed")
+
+
+@stages.timed
 def check_flair_changes(subreddit, database):
 	if len(subreddit.mod_log):
 		for log_item in subreddit.mod_log:
@@ -398,6 +439,7 @@ def check_flair_changes(subreddit, database):
 	# 		)
 
 
+@stages.timed
 def backfill_karma(subreddit, database):
 	max_date = datetime.utcnow() - timedelta(hours=24)
 	fullnames = []
@@ -420,10 +462,14 @@ def backfill_karma(subreddit, database):
 		object_map[submission.fullname()] = submission
 
 	if len(fullnames) > 0:
-		reddit_objects = subreddit.reddit.info(fullnames)
+		reddit_objects = subreddit.mod_pool.info(fullnames, task="backfill_karma")
+		if reddit_objects is None:
+			return
+		history_deltas = defaultdict(lambda: [0, 0, 0, 0])
 		for reddit_object in reddit_objects:
 			db_object = object_map[reddit_object.name]
 			db_object.karma = reddit_object.score
+			was_removed = db_object.is_removed
 			obj_type = "object"
 			result = "updated"
 			if reddit_object.name.startswith("t1_"):
@@ -457,15 +503,25 @@ def backfill_karma(subreddit, database):
 				# 		f"<https://www.reddit.com/r/{subreddit.name}/comments/{db_object.submission_id}/>")
 			else:
 				log.warning(f"Something went wrong backfilling karma. Unknown object type: {reddit_object.name}")
+
+			deltas = history_deltas[(db_object.author_id, subreddit.sub_id, db_object.created.date())]
+			if obj_type == "comment":
+				deltas[0] -= 1 if db_object.is_removed and not was_removed else 0
+				deltas[2] += reddit_object.score
+			elif obj_type == "submission":
+				deltas[1] -= 1 if db_object.is_removed and not was_removed else 0
+				deltas[3] += reddit_object.score
 			counters.backfill.labels(subreddit=subreddit.name, type=obj_type, result=result).inc()
 
 			del object_map[reddit_object.name]
+		database.adjust_user_history(history_deltas)
 
 		if len(object_map) > 0:
 			counters.backfill.labels(subreddit=subreddit.name, type="object", result="missing").inc(len(object_map))
 			log.warning(f"{len(object_map)} objects missing when backfilling karma for r/{subreddit.name}. {(','.join(object_map.keys()))} : {(','.join(fullnames))}")
 
 
+@stages.timed
 def check_messages(subreddit, database):
 	for item in subreddit.reddit.inbox.unread():
 		if isinstance(item, Message) and item.author is not None:
@@ -0,0 +1,56 @@
+import time
+import discord_logging
+
+log = discord_logging.get_logger()
+
+import counters
+
+# requests per account that deferrable work leaves for moderation actions, out of roughly 1000 per ten minute window
+reserve = 100
+accounts = {}
+
+
+def register(name, reddit):
+	accounts.setdefault(name, []).append(reddit)
+
+
+def get_limits(reddit):
+	limits = reddit.auth.limits
+	if limits['remaining'] is None:
+		return None, None
+	return limits['remaining'], max(limits['reset_timestamp'] - time.time(), 0)
+
+
+def update():
+	for name, instances in accounts.items():
+		remaining, seconds_to_reset = None, None
+		for reddit in instances:
+			instance_remaining, instance_seconds = get_limits(reddit)
+			if instance_remaining is not None and (remaining is None or instance_remaining < remaining):
+				remaining, seconds_to_reset = instance_remaining, instance_seconds
+		if remaining is not None:
+			counters.api_remaining.labels(account=name).set(remaining)
+			counters.api_reset.labels(account=name).set(round(seconds_to_reset))
+
+
+def request(reddit, cost, task):
+	# deferrable work calls this before starting, and skips this run if it would eat into the reserve
+	remaining, seconds_to_reset = get_limits(reddit)
+	if remaining is None or remaining - cost >= reserve:
+		return True
+
+	counters.api_deferred.labels(task=task).inc()
+	log.info(f"Deferring {task}, it needs {cost} requests and {remaining:.0f} are left for the next {seconds_to_reset:.0f} seconds")
+	return False
+
+
+def interval(reddit, interval, max_interval, cost=1, share=4):
+	# a frequent task keeps its interval while the window has plenty left, and stretches towards max_interval so it
+	# never uses more than its share of whatever is left above the reserve before the window resets
+	remaining, seconds_to_reset = get_limits(reddit)
+	if remaining is None:
+		return interval
+	spare = (remaining - reserve) / share
+	if spare < cost:
+		return max_interval
+	return min(max(interval, seconds_to_reset * cost / spare), max_interval)
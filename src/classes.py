@@ -4,11 +4,13 @@ import json
 import base64
 import zlib
 import re
-import requests
 import prawcore.exceptions
 
 log = discord_logging.get_logger()
 
+from read_pool import ReadPool
+import notifications
+
 
 class Subreddit:
 	def __init__(
@@ -64,6 +66,9 @@ class Subreddit:
 				self.rules_by_number[f"r{rule.rule_number}"] = rule
 
 		self.sub_object = reddit.subreddit(self.name)
+		# mod only fields like banned_by and removing things need one of the mod accounts, scores can come from any of them
+		self.mod_pool = ReadPool([reddit, backup_reddit])
+		self.read_pool = ReadPool([reddit, backup_reddit, non_mod_reddit])
 		self.post_checked = datetime.utcnow()
 		self.posts_notified = Queue(50)
 		self.processed_modmails = {}
@@ -78,12 +83,18 @@ class Subreddit:
 		self.oldest_unmod_link = None
 
 		self._modqueue = None
+		self.modqueue_fetched = None
+		self.modqueue_handled = set()
+		self.modqueue_fingerprints = {}
 		self._all_modmail = None
-		self._archived_modmail = None
-		self._appeal_modmail = None
+		self._unmoderated = None
+		self.modmail_synced = None
 		self.mod_log = []
 		self.recent_overlaps = Queue(50)
 		self.approved = []
+		self.usernotes = None
+		self.usernotes_revision = None
+		self.usernotes_pending_ids = set()
 
 		self.sub_object._fetch()
 		self.case_sensitive_name = self.sub_object.display_name
@@ -98,6 +109,12 @@ class Subreddit:
 	def get_account_name(self):
 		return self.reddit.user.me().name
 
+	def account_names(self):
+		names = {self.get_account_name()}
+		if self.backup_reddit is not None:
+			names.add(self.backup_reddit.user.me().name)
+		return names
+
 	def approve_comment(self, comment, sticky=False):
 		try:
 			comment.mod.approve()
@@ -164,7 +181,8 @@ class Subreddit:
 
 	def modqueue(self):
 		if self._modqueue is None:
-			self._modqueue = list(self.sub_object.mod.modqueue())
+			self._modqueue = list(self.sub_object.mod.modqueue(limit=None))
+			self.modqueue_fetched = datetime.utcnow()
 		return self._modqueue
 
 	def all_modmail(self):
@@ -172,26 +190,25 @@ class Subreddit:
 			self._all_modmail = [mail for mail in self.sub_object.modmail.conversations(state='all') if not mail.is_internal]
 		return self._all_modmail
 
-	def archived_modmail(self):
-		if self._archived_modmail is None:
-			self._archived_modmail = list(self.sub_object.modmail.conversations(state='archived', limit=10))
-		return self._archived_modmail
+	def unmoderated(self):
+		if self._unmoderated is None:
+			self._unmoderated = list(self.sub_object.mod.unmoderated())
+		return self._unmoderated
 
-	def appeal_modmail(self):
-		if self._appeal_modmail is None:
-			self._appeal_modmail = list(self.sub_object.modmail.conversations(state='appeals'))
-		return self._appeal_modmail
+	def expire_modqueue(self, max_age):
+		# the modqueue task usually fetched it moments ago, along with which items it handled, so only drop it if that's
+		# out of date
+		if self._modqueue is not None and self.modqueue_fetched < datetime.utcnow() - max_age:
+			self.clear_modqueue()
 
-	def combined_modmail(self):
-		combined_modmail = list(self.all_modmail())
-		combined_modmail.extend(list(self.appeal_modmail()))
-		return combined_modmail
-
-	def clear_cache(self):
+	def clear_modqueue(self):
 		self._modqueue = None
+		self.modqueue_handled = set()
+		# only the modqueue handlers use the modmail listing
 		self._all_modmail = None
-		self._archived_modmail = None
-		self._appeal_modmail = None
+
+	def clear_queue_counts(self):
+		self._unmoderated = None
 		self.mail_count = 0
 		self.unmod_count = 0
 		self.reported_count = 0
@@ -211,12 +228,41 @@ class Subreddit:
 			return f"u/{name}"
 
 	def post_to_discord(self, message):
-		requests.post(self.webhook, data={"content": message})
-
+		notifications.post(self.webhook, message)
+
+
+
+def split_json_object(json_text):
+	# splits the top level of a json object into the raw text of each value. raw_decode still parses every value to
+	# find where it ends, so this isn't a deferred parse, but the decoded values are dropped straight away instead of
+	# being built into notes objects. scanning for the ends in python without decoding was several times slower
+	decoder = json.JSONDecoder()
+	whitespace = re.compile(r'[ \t\n\r]*')
+	fragments = {}
+	index = whitespace.match(json_text, 0).end()
+	if json_text[index] != '{':
+		raise ValueError(f"Expected a json object at {index}")
+	index = whitespace.match(json_text, index + 1).end()
+	if json_text[index] == '}':
+		return fragments
+	while True:
+		key, index = decoder.raw_decode(json_text, index)
+		index = whitespace.match(json_text, index).end()
+		if json_text[index] != ':':
+			raise ValueError(f"Expected ':' at {index}")
+		value_start = whitespace.match(json_text, index + 1).end()
+		_, index = decoder.raw_decode(json_text, value_start)
+		fragments[key] = json_text[value_start:index]
+		index = whitespace.match(json_text, index).end()
+		if json_text[index] == '}':
+			return fragments
+		if json_text[index] != ',':
+			raise ValueError(f"Expected ',' or '}}' at {index}")
+		index = whitespace.match(json_text, index + 1).end()
 
 
 class SubredditNotes:
-	def __init__(self, subreddit_name, version, users, warnings, all_notes=None):
+	def __init__(self, subreddit_name, version, users, warnings, all_notes=None, raw_notes=None):
 		self.subreddit_name = subreddit_name
 		self.version = version
 
@@ -232,19 +278,26 @@ class SubredditNotes:
 			self.order_to_warning[index] = warning
 			self.warning_to_order[warning] = index
 
+		# users we've looked at are built into all_notes, everyone else is kept as the raw json text from the blob and
+		# written back out unchanged
 		if all_notes is not None:
 			self.all_notes = all_notes
 		else:
 			self.all_notes = {}
+		if raw_notes is not None:
+			self.raw_notes = raw_notes
+		else:
+			self.raw_notes = {}
 
 	def to_dict(self):
-		notes_dict = {}
-		total_notes = 0
+		user_fragments = []
+		for username, fragment in self.raw_notes.items():
+			if username not in self.all_notes:
+				user_fragments.append(f"{json.dumps(username)}:{fragment}")
 		for username, user_note in self.all_notes.items():
-			total_notes += len(user_note.notes)
-			notes_dict[username] = user_note.to_dict()
+			user_fragments.append(f"{json.dumps(username)}:{json.dumps(user_note.to_dict())}")
 
-		blob = json.dumps(notes_dict).encode()
+		blob = ("{" + ",".join(user_fragments) + "}").encode()
 		compressed_blob = zlib.compress(blob)
 		encoded_blob = base64.b64encode(compressed_blob).decode()
 
@@ -255,7 +308,7 @@ class SubredditNotes:
 		for index in range(len(self.order_to_warning)):
 			warnings_list.append(self.order_to_warning[index])
 
-		log.info(f"Exported notes for r/{self.subreddit_name}: {len(notes_dict)} : {total_notes}")
+		log.info(f"Exported notes for r/{self.subreddit_name}: {len(user_fragments)} : {len(self.all_notes)} decoded")
 		return {
 			'ver': 6,
 			'constants': {
@@ -268,9 +321,35 @@ class SubredditNotes:
 	def add_update_user_note(self, user_note):
 		self.all_notes[user_note.username] = user_note
 
+	def add_mod(self, mod_name):
+		if mod_name not in self.user_to_order:
+			index = len(self.order_to_user)
+			self.order_to_user[index] = mod_name
+			self.user_to_order[mod_name] = index
+
+	def add_new_note(self, username, note):
+		user_note = self.get_user_note(username)
+		if user_note is None:
+			user_note = UserNotes(username)
+			self.add_update_user_note(user_note)
+		user_note.add_new_note(note)
+
 	def get_user_note(self, username):
 		if username in self.all_notes:
 			return self.all_notes[username]
+		elif username in self.raw_notes:
+			user_notes = UserNotes(username)
+			for note_dict in json.loads(self.raw_notes[username])['ns']:
+				user_notes.notes.append(Note(
+					sub_notes=self,
+					mod_id=note_dict['m'],
+					warning_id=note_dict.get('w'),
+					note_text=note_dict['n'],
+					note_timestamp=note_dict['t'],
+					short_link=note_dict.get('l')
+				))
+			self.all_notes[username] = user_notes
+			return user_notes
 		else:
 			return None
 
@@ -288,24 +367,9 @@ class SubredditNotes:
 		blob = json_data["blob"]
 		decoded = base64.b64decode(blob)
 		raw = zlib.decompress(decoded)
-		parsed = json.loads(raw)
-
-		total_notes = 0
-		for username, notes_dict in parsed.items():
-			user_notes = UserNotes(username)
-			for note_dict in notes_dict['ns']:
-				total_notes += 1
-				user_notes.notes.append(Note(
-					sub_notes=sub_notes,
-					mod_id=note_dict['m'],
-					warning_id=note_dict.get('w'),
-					note_text=note_dict['n'],
-					note_timestamp=note_dict['t'],
-					short_link=note_dict.get('l')
-				))
-			sub_notes.add_update_user_note(user_notes)
+		sub_notes.raw_notes = split_json_object(raw.decode())
 
-		log.info(f"Loaded notes for r/{subreddit_name}: {len(sub_notes.all_notes)} : {total_notes}")
+		log.info(f"Loaded notes for r/{subreddit_name}: {len(sub_notes.raw_notes)}")
 		return sub_notes
 
 
@@ -5,7 +5,10 @@ from datetime import datetime
 
 log = discord_logging.get_logger()
 
+import stages
 
+
+@stages.timed
 def process_submissions(subreddit):
 	for submission in subreddit.sub_object.new(limit=25):
 		processed = False
@@ -39,25 +42,24 @@ def process_submissions(subreddit):
 			subreddit.post_to_discord(blame_string)
 
 
-def parse_modmail(subreddit):
-	for conversation in list(subreddit.all_modmail()):
+@stages.timed
+def parse_modmail(subreddit, database):
+	for conversation in database.get_single_message_modmail(subreddit.name, ["AutoModerator"]):
 		archive = None
-		if len(conversation.authors) == 1 and \
-				conversation.authors[0].name in {"AutoModerator"} and \
-				len(conversation.messages) == 1:
-			links = re.findall(r'(?:reddit.com/r/\w*/comments/)(\w*)', conversation.messages[0].body_markdown)
-			if len(links) == 1:
-				submission = subreddit.reddit.submission(links[0])
-				if submission.selftext == "[deleted]" or submission.author == "[deleted]":
-					archive = "Deleted by user"
-				elif submission.locked or submission.removed:
-					if len(submission.comments) and submission.comments[0].stickied:
-						archive = f"Removed by u/{submission.comments[0].author.name}"
-				elif submission.approved:
-					archive = f"Approved by u/{submission.approved_by}"
-
-			if archive is not None:
-				log.info(f"Archiving automod notification: {conversation.id}")
-				conversation.reply(archive, internal=True)
-				conversation.archive()
-				subreddit.all_modmail().remove(conversation)
+		links = re.findall(r'(?:reddit.com/r/\w*/comments/)(\w*)', conversation.first_message or "")
+		if len(links) == 1:
+			submission = subreddit.reddit.submission(links[0])
+			if submission.selftext == "[deleted]" or submission.author == "[deleted]":
+				archive = "Deleted by user"
+			elif submission.locked or submission.removed:
+				if len(submission.comments) and submission.comments[0].stickied:
+					archive = f"Removed by u/{submission.comments[0].author.name}"
+			elif submission.approved:
+				archive = f"Approved by u/{submission.approved_by}"
+
+		if archive is not None:
+			log.info(f"Archiving automod notification: {conversation.id}")
+			reddit_conversation = subreddit.sub_object.modmail(conversation.id)
+			reddit_conversation.reply(body=archive, internal=True)
+			reddit_conversation.archive()
+			database.set_modmail_state(conversation.id, 'archived')
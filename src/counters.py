@@ -3,8 +3,24 @@ import prometheus_client
 mod_actions = prometheus_client.Counter("bot_mod_actions", "Mod actions by moderator", ['moderator', 'subreddit'])
 queue_size = prometheus_client.Gauge("bot_queue_size", "Queue size", ['type', 'subreddit'])
 loop_time = prometheus_client.Summary('bot_loop_time', "How long it took for one loop")
+subreddit_loop_time = prometheus_client.Summary('bot_subreddit_loop_time', "How long it took for one loop of a subreddit", ['subreddit'])
+task_time = prometheus_client.Summary('bot_task_time', "How long it took for one run of a scheduled task", ['task'])
 user_comments = prometheus_client.Counter("bot_user_comments", "Comments in subreddit", ['subreddit', 'result'])
 backfill = prometheus_client.Counter("bot_backfill", "Backfill results", ['subreddit', 'type', 'result'])
+usernotes_cache = prometheus_client.Counter("bot_usernotes_cache", "Usernotes cache lookups", ['subreddit', 'result'])
+modqueue_new_items = prometheus_client.Gauge("bot_modqueue_new_items", "Modqueue items that were new or changed since the last loop", ['subreddit'])
+api_remaining = prometheus_client.Gauge("bot_api_remaining", "Reddit api requests left in the current window", ['account'])
+api_reset = prometheus_client.Gauge("bot_api_reset", "Seconds until the reddit api window resets", ['account'])
+api_deferred = prometheus_client.Counter("bot_api_deferred", "Runs of deferrable work skipped to save api budget", ['task'])
+notifications = prometheus_client.Counter("bot_notifications", "Discord notification sends", ['result'])
+stage_time = prometheus_client.Histogram(
+	'bot_stage_seconds', "How long each stage of a task took", ['subreddit', 'stage'],
+	buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+sql_queries = prometheus_client.Counter("bot_sql_queries", "Database queries by stage", ['subreddit', 'stage'])
+sql_time = prometheus_client.Counter("bot_sql_seconds", "Time spent in database queries by stage", ['subreddit', 'stage'])
+sql_slow_queries = prometheus_client.Counter("bot_sql_slow_queries", "Database queries over the slow query threshold by stage", ['subreddit', 'stage'])
+reddit_requests = prometheus_client.Counter("bot_reddit_requests", "Reddit api requests by endpoint and the stage that made them", ['method', 'endpoint', 'subreddit', 'stage', 'status'])
+reddit_request_time = prometheus_client.Summary('bot_reddit_request_seconds', "Reddit api request latency by endpoint", ['method', 'endpoint'])
 objects = prometheus_client.Gauge('bot_objects', "Total number of objects by type", ['type', 'subreddit'])
 
 
@@ -1,16 +1,21 @@
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import create_engine, Column, String, DateTime, Integer, ForeignKey, Boolean
+from sqlalchemy import create_engine, inspect, Column, String, DateTime, Date, Integer, ForeignKey, Boolean, Index
 from sqlalchemy.orm import sessionmaker, relationship, aliased
-from sqlalchemy.sql import func
+from sqlalchemy.sql import func, text, case, distinct
+from sqlalchemy.dialects.sqlite import insert
+from collections import defaultdict
 from datetime import datetime, timedelta
 import os
 import time
-from shutil import copyfile
+import sqlite3
+import threading
 import discord_logging
 
 log = discord_logging.get_logger()
 
 import counters
+import stages
+import backup_store
 
 
 Base = declarative_base()
@@ -18,6 +23,10 @@ Base = declarative_base()
 
 class LogItem(Base):
 	__tablename__ = 'log'
+	__table_args__ = (
+		Index('ix_log_subreddit_created', 'subreddit', 'created'),
+		Index('ix_log_target_fullname', 'target_fullname'),
+	)
 
 	id = Column(String(60), primary_key=True)
 	created = Column(DateTime, nullable=False)
@@ -33,18 +42,38 @@ class LogItem(Base):
 	subreddit = Column(String(60))
 
 	def __init__(self, log_item):
-		self.id = log_item.id
-		self.created = datetime.utcfromtimestamp(log_item.created_utc)
-		self.mod = log_item.mod.name
-		self.action = log_item.action
-		self.details = log_item.details
-		self.target_author = log_item.target_author if log_item.target_author else None
-		self.target_fullname = log_item.target_fullname
-		self.target_permalink = log_item.target_permalink
-		self.target_title = log_item.target_title
-		self.target_body = log_item.target_body
-		self.description = log_item.description
-		self.subreddit = log_item.subreddit
+		for key, value in LogItem.to_row(log_item).items():
+			setattr(self, key, value)
+
+	@staticmethod
+	def to_row(log_item):
+		return {
+			'id': log_item.id,
+			'created': datetime.utcfromtimestamp(log_item.created_utc),
+			'mod': log_item.mod.name,
+			'action': log_item.action,
+			'details': log_item.details,
+			'target_author': log_item.target_author if log_item.target_author else None,
+			'target_fullname': log_item.target_fullname,
+			'target_permalink': log_item.target_permalink,
+			'target_title': log_item.target_title,
+			'target_body': log_item.target_body,
+			'description': log_item.description,
+			'subreddit': log_item.subreddit,
+		}
+
+
+class LogCursor(Base):
+	__tablename__ = 'log_cursors'
+
+	subreddit = Column(String(60), primary_key=True)
+	log_id = Column(String(60), nullable=False)
+	created = Column(DateTime, nullable=False)
+
+	def __init__(self, subreddit, log_id, created):
+		self.subreddit = subreddit
+		self.log_id = log_id
+		self.created = created
 
 
 class User(Base):
@@ -72,6 +101,10 @@ class User(Base):
 
 class Submission(Base):
 	__tablename__ = 'submissions'
+	__table_args__ = (
+		Index('ix_submissions_author_restricted_created', 'author_id', 'is_restricted', 'created'),
+		Index('ix_submissions_karma_null', 'subreddit_id', 'created', sqlite_where=text('karma is null')),
+	)
 
 	id = Column(Integer, primary_key=True)
 	submission_id = Column(String(12), nullable=False, unique=True)
@@ -116,6 +149,12 @@ class Submission(Base):
 
 class Comment(Base):
 	__tablename__ = 'comments'
+	__table_args__ = (
+		Index('ix_comments_author_subreddit_created', 'author_id', 'subreddit_id', 'created', 'is_removed'),
+		Index('ix_comments_submission', 'submission_id'),
+		Index('ix_comments_created', 'created'),
+		Index('ix_comments_karma_null', 'subreddit_id', 'created', sqlite_where=text('karma is null')),
+	)
 
 	id = Column(Integer, primary_key=True)
 	comment_id = Column(String(12), nullable=False, unique=True)
@@ -160,38 +199,479 @@ class Comment(Base):
 		return f"t1_{self.comment_id}"
 
 
+class UserHistory(Base):
+	__tablename__ = 'user_history'
+
+	user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+	subreddit_id = Column(Integer, primary_key=True)
+	day = Column(Date, primary_key=True)
+	comments = Column(Integer, nullable=False, default=0)
+	submissions = Column(Integer, nullable=False, default=0)
+	comment_karma = Column(Integer, nullable=False, default=0)
+	submission_karma = Column(Integer, nullable=False, default=0)
+
+
+class PendingNote(Base):
+	__tablename__ = 'pending_notes'
+
+	id = Column(Integer, primary_key=True)
+	subreddit = Column(String(60), nullable=False)
+	username = Column(String(80), nullable=False)
+	mod = Column(String(80), nullable=False)
+	note_type = Column(String(40), nullable=False)
+	note_text = Column(String(300), nullable=False)
+	permalink = Column(String(300))
+	created = Column(DateTime, nullable=False)
+
+	def __init__(self, subreddit, username, mod, note_type, note_text, permalink, created=None):
+		self.subreddit = subreddit
+		self.username = username
+		self.mod = mod
+		self.note_type = note_type
+		self.note_text = note_text
+		self.permalink = permalink
+		self.created = created if created is not None else datetime.utcnow()
+
+
+class DeferredComment(Base):
+	__tablename__ = 'deferred_comments'
+
+	comment_id = Column(String(12), primary_key=True)
+	subreddit_id = Column(Integer, nullable=False)
+	deferred = Column(DateTime, nullable=False)
+
+	def __init__(self, comment_id, subreddit_id, deferred=None):
+		self.comment_id = comment_id
+		self.subreddit_id = subreddit_id
+		self.deferred = deferred if deferred is not None else datetime.utcnow()
+
+
+class Modmail(Base):
+	__tablename__ = 'modmail'
+	__table_args__ = (
+		Index('ix_modmail_subreddit_state_updated', 'subreddit', 'state', 'last_updated'),
+		Index('ix_modmail_subreddit_state_highlighted', 'subreddit', 'state', 'is_highlighted', 'last_updated'),
+	)
+
+	id = Column(String(20), primary_key=True)
+	subreddit = Column(String(60), nullable=False)
+	state = Column(String(20), nullable=False)
+	is_highlighted = Column(Boolean, nullable=False)
+	is_internal = Column(Boolean, nullable=False)
+	is_admin = Column(Boolean, nullable=False)
+	last_updated = Column(DateTime, nullable=False)
+	last_unread = Column(DateTime)
+	last_user_update = Column(DateTime)
+	last_mod_update = Column(DateTime)
+	num_messages = Column(Integer, nullable=False)
+	authors = Column(String(400), nullable=False)
+	first_message = Column(String(4000))
+	last_action_by = Column(String(80))
+	synced = Column(DateTime, nullable=False)
+
+	def author_names(self):
+		return self.authors.split(" ") if self.authors else []
+
+
+class ModmailAuthor(Base):
+	__tablename__ = 'modmail_authors'
+
+	conversation_id = Column(String(20), ForeignKey('modmail.id'), primary_key=True)
+	name = Column(String(80), primary_key=True)
+
+
+class SchemaVersion(Base):
+	__tablename__ = 'schema_version'
+
+	version = Column(Integer, primary_key=True)
+	description = Column(String(200), nullable=False)
+	applied = Column(DateTime, nullable=False)
+
+	def __init__(self, version, description):
+		self.version = version
+		self.description = description
+		self.applied = datetime.utcnow()
+
+
+def migrate_create_indexes(database):
+	# create_all only creates indexes along with new tables, so add any the existing tables are missing
+	connection = database.session.connection()
+	for table in Base.metadata.sorted_tables:
+		for index in table.indexes:
+			log.info(f"Creating index {index.name}")
+			index.create(connection, checkfirst=True)
+	database.session.execute(text("analyze"))
+
+
+def migrate_rebuild_user_history(database):
+	database.rebuild_user_history()
+
+
+def migrate_modmail_authors(database):
+	conversations = database.session.query(Modmail).all()
+	database.set_modmail_authors({conversation.id: conversation.author_names() for conversation in conversations})
+
+
+# append only, each migration runs once against a database in version order
+MIGRATIONS = [
+	(1, "Create indexes for the comment, submission and log filters", migrate_create_indexes),
+	(2, "Build the user history summary", migrate_rebuild_user_history),
+	(3, "Split modmail authors into their own table", migrate_modmail_authors),
+]
+
+
+class BackupRestarted(Exception):
+	pass
+
+
+def backup_progress(max_restarts):
+	previous_remaining = None
+	restarts = 0
+	reported = 0
+
+	def progress(status, remaining, total):
+		nonlocal previous_remaining, restarts, reported
+		# a write from another connection sends the copy back to the start
+		if previous_remaining is not None and remaining > previous_remaining:
+			restarts += 1
+			reported = 0
+			if restarts > max_restarts:
+				raise BackupRestarted()
+		previous_remaining = remaining
+		percent = int((total - remaining) * 100 / total) if total else 100
+		if percent >= reported + 10:
+			reported = percent - percent % 10
+			log.info(f"Backup {percent}%: {total - remaining}/{total} pages")
+	return progress
+
+
+def integrity_check(location):
+	connection = sqlite3.connect(location)
+	try:
+		return "; ".join(row[0] for row in connection.execute("pragma integrity_check"))
+	finally:
+		connection.close()
+
+
+def backup_database(source_location, backup_folder, name, pages_per_step=4096, step_sleep=0.05, max_restarts=5):
+	start_time = time.perf_counter()
+	# the full copy is only temporary, the store keeps the chunks that changed since the last backup. the backup api can
+	# only write into another database, and python's sqlite isn't built with sqlite_dbpage to read a snapshot's pages
+	# directly, so the pages can't be streamed into the store without it
+	partial_location = os.path.join(backup_folder, name + ".db.partial")
+	try:
+		source = sqlite3.connect(source_location, timeout=60)
+		target = sqlite3.connect(partial_location)
+		try:
+			try:
+				source.backup(target, pages=pages_per_step, progress=backup_progress(max_restarts), sleep=step_sleep)
+			except BackupRestarted:
+				# the loop keeps committing, so copy everything from one snapshot instead. in wal mode that doesn't block writers
+				log.info(f"Backup restarted {max_restarts} times, copying in one step")
+				source.backup(target)
+		finally:
+			target.close()
+			source.close()
+
+		result = integrity_check(partial_location)
+		if result == "ok":
+			backup_store.store(partial_location, backup_folder, name)
+			os.remove(partial_location)
+			backup_store.rotate(backup_folder)
+			log.info(f"Backed up {name} in {time.perf_counter() - start_time:.2f} seconds")
+		else:
+			os.replace(partial_location, os.path.join(backup_folder, name + ".db.failed"))
+			log.warning(f"Backup {name} failed its integrity check: {result[:500]}")
+	except Exception as err:
+		log.warning(f"Backup {name} failed: {err}")
+
+
 class Database:
 	def __init__(self, location="database.db"):
 		self.engine = None
 		self.session = None
 		self.location = location
+		self.backup_thread = None
 		self.init(self.location)
 
 	def init(self, location):
-		self.engine = create_engine(f'sqlite:///{location}')
+		# other workers may hold the write lock on the same file, so wait for them instead of failing right away
+		self.engine = create_engine(f'sqlite:///{location}', connect_args={'timeout': 60})
+		stages.instrument_engine(self.engine)
 		session_maker = sessionmaker(bind=self.engine)
 		self.session = session_maker()
 		Base.metadata.create_all(self.engine)
 		self.session.commit()
+		# readers don't block writers in wal mode, so a backup can read a snapshot while the loop keeps committing
+		with self.engine.connect() as connection:
+			connection.exec_driver_sql("pragma journal_mode=wal")
+
+		self.migrate()
+		self.check_indexes()
+
+	def migrate(self):
+		current_version = self.session.query(func.max(SchemaVersion.version)).scalar() or 0
+		for version, description, migration in MIGRATIONS:
+			if version <= current_version:
+				continue
+			log.info(f"Migrating database to version {version}: {description}")
+			start_time = time.perf_counter()
+			migration(self)
+			self.session.add(SchemaVersion(version, description))
+			self.session.commit()
+			log.info(f"Migrated to version {version} in {time.perf_counter() - start_time:.2f} seconds")
+
+	def check_indexes(self):
+		inspector = inspect(self.engine)
+		missing_indexes = []
+		for table in Base.metadata.sorted_tables:
+			existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+			for index in table.indexes:
+				if index.name not in existing_indexes:
+					missing_indexes.append(index.name)
+		if len(missing_indexes):
+			log.warning(f"Database is missing indexes: {', '.join(missing_indexes)}")
+		return missing_indexes
+
+	def commit(self):
+		# for callbacks that need to commit whatever session the database currently has
+		self.session.commit()
+
+	def release_write_lock(self):
+		# sqlite holds the write lock from a transaction's first write until its commit, so committing here lets another
+		# worker's writes go ahead while this one waits on the network instead of timing out with "database is locked"
+		if self.session.new or self.session.dirty or self.session.deleted:
+			self.session.commit()
+		elif self.session.in_transaction() and self.session.connection().connection.dbapi_connection.in_transaction:
+			self.session.commit()
 
 	def close(self):
 		self.session.commit()
 		self.engine.dispose()
 
 	def backup(self, backup_folder="backup"):
-		self.close()
+		# the copy runs on its own thread through sqlite's online backup api, the loop keeps using the session meanwhile
+		if self.backup_thread is not None and self.backup_thread.is_alive():
+			log.info("Previous backup is still running, skipping")
+			return
+		self.session.commit()
 
 		if not os.path.exists(backup_folder):
 			os.makedirs(backup_folder)
-
-		copyfile(
-			self.location,
-			backup_folder + "/" +
-				datetime.utcnow().strftime("%Y-%m-%d_%H-%M") +
-				".db"
-		)
-
-		self.init(self.location)
+		name = datetime.utcnow().strftime(backup_store.SNAPSHOT_FORMAT)
+		self.backup_thread = threading.Thread(target=backup_database, args=(self.location, backup_folder, name), name="backup")
+		self.backup_thread.start()
+
+	def get_log_cursor(self, subreddit_name):
+		cursor = self.session.query(LogCursor).filter_by(subreddit=subreddit_name).first()
+		if cursor is None:
+			# no cursor saved yet, start from the newest item already in the log table
+			newest_item = self.session.query(LogItem).filter_by(subreddit=subreddit_name).order_by(LogItem.created.desc()).first()
+			if newest_item is not None:
+				cursor = LogCursor(subreddit_name, newest_item.id, newest_item.created)
+				self.session.add(cursor)
+		return cursor
+
+	def set_log_cursor(self, subreddit_name, log_id, created):
+		cursor = self.session.query(LogCursor).filter_by(subreddit=subreddit_name).first()
+		if cursor is None:
+			self.session.add(LogCursor(subreddit_name, log_id, created))
+		else:
+			cursor.log_id = log_id
+			cursor.created = created
+
+	def add_log_items(self, rows, batch_size=500):
+		for index in range(0, len(rows), batch_size):
+			self.session.execute(insert(LogItem).values(rows[index:index + batch_size]).on_conflict_do_nothing())
+
+	def get_modmail_cursor(self, subreddit_name, state):
+		return self.session.query(func.max(Modmail.last_updated))\
+			.filter(Modmail.subreddit == subreddit_name)\
+			.filter(Modmail.state == state)\
+			.scalar()
+
+	def add_modmail(self, rows, batch_size=200):
+		for index in range(0, len(rows), batch_size):
+			statement = insert(Modmail).values(rows[index:index + batch_size])
+			statement = statement.on_conflict_do_update(
+				index_elements=['id'],
+				set_={column: statement.excluded[column] for column in rows[0].keys() if column != 'id'}
+			)
+			self.session.execute(statement)
+			self.set_modmail_authors({row['id']: row['authors'].split(" ") if row['authors'] else [] for row in rows[index:index + batch_size]})
+
+	def set_modmail_authors(self, conversation_authors, batch_size=400):
+		conversation_ids = list(conversation_authors)
+		for index in range(0, len(conversation_ids), batch_size):
+			self.session.query(ModmailAuthor)\
+				.filter(ModmailAuthor.conversation_id.in_(conversation_ids[index:index + batch_size]))\
+				.delete(synchronize_session=False)
+		rows = [
+			{'conversation_id': conversation_id, 'name': name}
+			for conversation_id, names in conversation_authors.items() for name in set(names)]
+		for index in range(0, len(rows), batch_size):
+			self.session.execute(insert(ModmailAuthor).values(rows[index:index + batch_size]))
+
+	def close_missing_modmail(self, subreddit_name, states, synced_before):
+		# anything in these states that a full listing didn't return has left them, usually by being archived
+		return self.session.query(Modmail)\
+			.filter(Modmail.subreddit == subreddit_name)\
+			.filter(Modmail.state.in_(states))\
+			.filter(Modmail.synced < synced_before)\
+			.update({Modmail.state: 'closed'}, synchronize_session=False)
+
+	def set_modmail_state(self, conversation_id, state):
+		self.session.query(Modmail).filter(Modmail.id == conversation_id).update({Modmail.state: state}, synchronize_session=False)
+
+	def get_modmail_queue(self, subreddit_name):
+		count, oldest = self.session.query(func.count(Modmail.id), func.min(Modmail.last_updated))\
+			.filter(Modmail.subreddit == subreddit_name)\
+			.filter(Modmail.state.in_(('all', 'appeals')))\
+			.filter(Modmail.is_highlighted == False)\
+			.filter((Modmail.is_internal == False) | (Modmail.state == 'appeals'))\
+			.one()
+		return count, oldest
+
+	def get_unread_flagged_modmail(self, subreddit_name, updated_after):
+		return self.session.query(Modmail)\
+			.filter(Modmail.subreddit == subreddit_name)\
+			.filter(Modmail.state == 'all')\
+			.filter(Modmail.is_internal == False)\
+			.filter(Modmail.last_updated > updated_after)\
+			.filter(Modmail.last_unread > Modmail.last_updated)\
+			.filter((Modmail.is_highlighted == True) | (Modmail.is_admin == True))\
+			.all()
+
+	def get_recent_archived_modmail(self, subreddit_name, limit=10):
+		return self.session.query(Modmail)\
+			.filter(Modmail.subreddit == subreddit_name)\
+			.filter(Modmail.state == 'archived')\
+			.order_by(Modmail.last_updated.desc())\
+			.limit(limit)\
+			.all()
+
+	def get_single_message_modmail(self, subreddit_name, authors):
+		# conversations whose authors are exactly this set
+		authors = set(authors)
+		return self.session.query(Modmail)\
+			.join(ModmailAuthor, ModmailAuthor.conversation_id == Modmail.id)\
+			.filter(Modmail.subreddit == subreddit_name)\
+			.filter(Modmail.state == 'all')\
+			.filter(Modmail.is_internal == False)\
+			.filter(Modmail.num_messages == 1)\
+			.group_by(Modmail.id)\
+			.having(func.count(distinct(ModmailAuthor.name)) == len(authors))\
+			.having(func.sum(case((ModmailAuthor.name.in_(authors), 0), else_=1)) == 0)\
+			.order_by(Modmail.last_updated.desc())\
+			.all()
+
+	def add_deferred_comment(self, comment_id, subreddit_id):
+		if self.session.query(DeferredComment).filter_by(comment_id=comment_id).first() is None:
+			self.session.add(DeferredComment(comment_id, subreddit_id))
+
+	def get_deferred_comments(self, subreddit_id):
+		return self.session.query(DeferredComment)\
+			.filter(DeferredComment.subreddit_id == subreddit_id)\
+			.order_by(DeferredComment.deferred)\
+			.all()
+
+	def update_user_history(self, user, subreddit_id, created, comments=0, submissions=0, comment_karma=0, submission_karma=0):
+		if user.id is None:
+			self.session.flush()
+		self.adjust_user_history({
+			(user.id, subreddit_id, created.date()): [comments, submissions, comment_karma, submission_karma]
+		})
+
+	def adjust_user_history(self, deltas, batch_size=100):
+		# seven values per row, so batches stay under the 999 variable limit of older sqlite builds
+		rows = []
+		for (user_id, subreddit_id, day), (comments, submissions, comment_karma, submission_karma) in deltas.items():
+			rows.append({
+				'user_id': user_id,
+				'subreddit_id': subreddit_id,
+				'day': day,
+				'comments': comments,
+				'submissions': submissions,
+				'comment_karma': comment_karma,
+				'submission_karma': submission_karma,
+			})
+		for index in range(0, len(rows), batch_size):
+			statement = insert(UserHistory).values(rows[index:index + batch_size])
+			statement = statement.on_conflict_do_update(
+				index_elements=['user_id', 'subreddit_id', 'day'],
+				set_={
+					'comments': UserHistory.comments + statement.excluded.comments,
+					'submissions': UserHistory.submissions + statement.excluded.submissions,
+					'comment_karma': UserHistory.comment_karma + statement.excluded.comment_karma,
+					'submission_karma': UserHistory.submission_karma + statement.excluded.submission_karma,
+				}
+			)
+			self.session.execute(statement)
+
+	def delete_empty_user_history(self):
+		return self.session.query(UserHistory)\
+			.filter(UserHistory.comments == 0)\
+			.filter(UserHistory.submissions == 0)\
+			.filter(UserHistory.comment_karma == 0)\
+			.filter(UserHistory.submission_karma == 0)\
+			.delete(synchronize_session=False)
+
+	def get_bulk_user_history(self, subreddit_id, user_ids, threshold_date, batch_size=500):
+		# buckets are whole days, so the days before the threshold come from the history and the part of the threshold's
+		# own day before it is counted from the items themselves
+		threshold_day = datetime(threshold_date.year, threshold_date.month, threshold_date.day)
+		user_ids = list(user_ids)
+		results = {user_id: [0, 0, 0, 0] for user_id in user_ids}
+		for index in range(0, len(user_ids), batch_size):
+			batch_ids = user_ids[index:index + batch_size]
+			rows = self.session.query(
+					UserHistory.user_id,
+					func.sum(UserHistory.comments),
+					func.sum(UserHistory.submissions),
+					func.sum(UserHistory.comment_karma),
+					func.sum(UserHistory.submission_karma))\
+				.filter(UserHistory.user_id.in_(batch_ids))\
+				.filter(UserHistory.subreddit_id == subreddit_id)\
+				.filter(UserHistory.day < threshold_day.date())\
+				.group_by(UserHistory.user_id)\
+				.all()
+			for user_id, *counts in rows:
+				results[user_id] = [value if value is not None else 0 for value in counts]
+
+			for table, count_index, karma_index in ((Comment, 0, 2), (Submission, 1, 3)):
+				rows = self.session.query(
+						table.author_id,
+						func.sum(case((table.is_removed, 0), else_=1)),
+						func.sum(table.karma))\
+					.filter(table.author_id.in_(batch_ids))\
+					.filter(table.subreddit_id == subreddit_id)\
+					.filter(table.created >= threshold_day)\
+					.filter(table.created < threshold_date)\
+					.group_by(table.author_id)\
+					.all()
+				for user_id, count, karma in rows:
+					results[user_id][count_index] += count
+					results[user_id][karma_index] += karma if karma is not None else 0
+		return {user_id: tuple(counts) for user_id, counts in results.items()}
+
+	def rebuild_user_history(self):
+		start_time = time.perf_counter()
+		self.session.query(UserHistory).delete()
+		self.session.execute(text('''
+insert into user_history (user_id, subreddit_id, day, comments, submissions, comment_karma, submission_karma)
+select author_id, subreddit_id, date(created), sum(case when is_removed then 0 else 1 end), 0, coalesce(sum(karma), 0), 0
+from comments
+group by author_id, subreddit_id, date(created)'''))
+		self.session.execute(text('''
+insert into user_history (user_id, subreddit_id, day, comments, submissions, comment_karma, submission_karma)
+select author_id, subreddit_id, date(created), 0, sum(case when is_removed then 0 else 1 end), 0, coalesce(sum(karma), 0)
+from submissions
+where true
+group by author_id, subreddit_id, date(created)
+on conflict (user_id, subreddit_id, day) do update set
+	submissions = excluded.submissions,
+	submission_karma = excluded.submission_karma'''))
+		log.info(f"Rebuilt user history in {time.perf_counter() - start_time:.2f} seconds")
 
 	def get_user_counts(self, subreddit_id, user, threshold_date, is_deleted=None, is_removed=None):
 		comment_count, comment_karma = self.get_comment_counts(
@@ -277,8 +757,12 @@ class Database:
 		start_time = time.perf_counter()
 		deleted_comment_ids = []
 		before_date = datetime.utcnow() - timedelta(days=365)
+		history_deltas = defaultdict(lambda: [0, 0, 0, 0])
 		for comment in self.session.query(Comment).filter(Comment.created < before_date).limit(10000).all():
 			deleted_comment_ids.append(comment.comment_id)
+			deltas = history_deltas[(comment.author_id, comment.subreddit_id, comment.created.date())]
+			deltas[0] -= 0 if comment.is_removed else 1
+			deltas[2] -= comment.karma or 0
 			self.session.delete(comment)
 		if not len(deleted_comment_ids):
 			deleted_comment_ids.append("none")
@@ -292,9 +776,14 @@ class Database:
 				.join(subquery, Submission.id == subquery.c.submission_id, isouter=True)\
 				.filter(subquery.c.count == None).filter(Submission.created < before_date).limit(1000).all():
 			deleted_submission_ids.append(submission.submission_id)
+			deltas = history_deltas[(submission.author_id, submission.subreddit_id, submission.created.date())]
+			deltas[1] -= 0 if submission.is_removed else 1
+			deltas[3] -= submission.karma or 0
 			self.session.delete(submission)
 		if not len(deleted_submission_ids):
 			deleted_submission_ids.append("none")
+		self.adjust_user_history(history_deltas)
+		deleted_history = self.delete_empty_user_history()
 
 		deleted_users = []
 		for user in self.session.query(User)\
@@ -306,10 +795,20 @@ class Database:
 		if not len(deleted_users):
 			deleted_users.append("none")
 
+		expired_modmails = self.session.query(Modmail.id)\
+			.filter(Modmail.state.notin_(('all', 'appeals')))\
+			.filter(Modmail.last_updated < datetime.utcnow() - timedelta(days=30))
+		self.session.query(ModmailAuthor)\
+			.filter(ModmailAuthor.conversation_id.in_(expired_modmails.scalar_subquery()))\
+			.delete(synchronize_session=False)
+		deleted_modmails = self.session.query(Modmail)\
+			.filter(Modmail.id.in_(expired_modmails.scalar_subquery()))\
+			.delete(synchronize_session=False)
+
 		delta_time = time.perf_counter() - start_time
 		# log.info(
 		# 	f"Cleanup {' '.join(deleted_comment_ids)} : {' '.join(deleted_submission_ids)} : {' '.join(deleted_users)} in "
 		# 	f"{delta_time:.2f} seconds")
 		log.info(
-			f"Cleanup {len(deleted_comment_ids)} comments : {len(deleted_submission_ids)} submissions : {' '.join(deleted_users)} in "
+			f"Cleanup {len(deleted_comment_ids)} comments : {len(deleted_submission_ids)} submissions : {deleted_history} history rows : {deleted_modmails} modmails : {' '.join(deleted_users)} in "
 			f"{delta_time:.2f} seconds")
@@ -9,6 +9,8 @@ import time
 import traceback
 import discord_logging
 import argparse
+import asyncio
+import functools
 from datetime import datetime, timedelta
 
 log = discord_logging.init_logging()
@@ -16,54 +18,57 @@ log = discord_logging.init_logging()
 import counters
 import static
 import utils
+import budget
+import notifications
 import shared
 import bayarea
 import compow
 from classes import Subreddit
 from database import Database
+from scheduler import Scheduler
+from reddit_requestor import CountingRequestor, LockedReddit
+from recording import RecordingSession
 
-database = None
+databases = []
 start_time = datetime.utcnow()
+record_file = None
 
 
 def signal_handler(signal, frame):
 	log.info("Handling interrupt")
-	database.session.commit()
-	database.engine.dispose()
-	discord_logging.flush_discord()
+	for database in databases:
+		database.session.commit()
+		database.engine.dispose()
+	notifications.stop()
 	sys.exit(0)
 
 
 signal.signal(signal.SIGINT, signal_handler)
 
 
-if __name__ == "__main__":
-	parser = argparse.ArgumentParser(description="modqueue bot")
-	parser.add_argument("--once", help="Only run the loop once", action='store_const', const=True, default=False)
-	parser.add_argument("--debug", help="Set the log level to debug", action='store_const', const=True, default=False)
-	args = parser.parse_args()
-
-	if args.debug:
-		discord_logging.set_level(logging.DEBUG)
-
-	praw_file = discord_logging.get_config()
-	discord_logging.init_discord_logging("QueueBot", logging.WARNING, 1, logging_webhook=discord_logging.get_config_var(praw_file, "global", 'queue_webhook'))
-	database = Database()
-
+def login():
 	instances = {}
+	requestor_kwargs = {'session': RecordingSession(record_file)} if record_file is not None else None
 	for username in ['CustomModBot', 'Watchful1', 'Watchful1BotTest']:
 		try:
-			instances[username] = praw.Reddit(username, user_agent=static.USER_AGENT)
+			instances[username] = LockedReddit(
+				username, user_agent=static.USER_AGENT, requestor_class=CountingRequestor, requestor_kwargs=requestor_kwargs)
+			budget.register(username, instances[username])
 			log.info(f"Logged into reddit as /u/{instances[username].user.me().name}")
 		except configparser.NoSectionError:
-			log.error("User "+args.user+" not in praw.ini, aborting")
+			log.error("User "+username+" not in praw.ini, aborting")
 			sys.exit(0)
+	return instances
 
-	log.info(f"Python version {sys.version}")
 
-	counters.init(8003)
+def init_database():
+	database = Database()
+	databases.append(database)
+	return database
 
-	comp_ow = Subreddit(
+
+def build_comp_ow(instances, praw_file):
+	return Subreddit(
 		"CompetitiveOverwatch",
 		1,
 		instances['CustomModBot'],
@@ -85,7 +90,10 @@ if __name__ == "__main__":
 		webhook=discord_logging.get_config_var(praw_file, "CustomModBot", 'webhook_redditmodtalk'),
 		discord_link="https://discord.gg/competitiveow"
 	)
-	bay_area = Subreddit(
+
+
+def build_bay_area(instances, praw_file):
+	return Subreddit(
 		"bayarea",
 		2,
 		instances['CustomModBot'],
@@ -114,77 +122,156 @@ if __name__ == "__main__":
 		days_between_restricted_submissions=7
 	)
 
-	last_backup, last_periodic = None, None
-	while True:
-		loop_time = time.perf_counter()
-		try:
-			log.debug("Starting run")
-
-			if last_periodic is None or last_periodic < datetime.utcnow() - timedelta(minutes=15):
-				for subreddit in [bay_area]:
-					shared.update_approved(subreddit)
-				last_periodic = datetime.utcnow()
-
-			for subreddit in [comp_ow, bay_area]:
-				subreddit.clear_cache()
-
-			for subreddit in [comp_ow, bay_area]:
-				shared.ingest_log(subreddit, database)
-				#shared.process_modqueue_comments(subreddit)
-				shared.process_modqueue_comments_v2(subreddit)
-				#shared.process_modqueue_submissions(subreddit)
-				shared.process_modqueue_submissions_v2(subreddit)
-				shared.process_modqueue_old(subreddit)
-				shared.post_overlapping_actions(subreddit, database)
-				shared.log_highlighted_modmail(subreddit, start_time)
-
-			for subreddit in [comp_ow]:
-				shared.process_modqueue_reapprove(subreddit)
-				shared.log_archived_modmail_no_response(subreddit, start_time)
-
-				compow.process_submissions(subreddit)
-				compow.parse_modmail(subreddit)
-
-			for subreddit in [bay_area]:
-				bayarea.ingest_submissions(subreddit, database)
-				bayarea.ingest_comments(subreddit, database)
-				bayarea.check_flair_changes(subreddit, database)
-				bayarea.backfill_karma(subreddit, database)
-				bayarea.check_messages(subreddit, database)
-
-			for subreddit in [comp_ow, bay_area]:
-				shared.count_queues(subreddit)
-				shared.ping_queues(subreddit, database)
-
-			database.update_object_counts()
-			# database.cleanup()
-			if last_backup is None or last_backup < datetime.utcnow() - timedelta(hours=24):
-				try:
-					database.purge()
-				except Exception as err:
-					utils.process_error(f"Error purging database", err, traceback.format_exc())
-
-				try:
-					log.info("Backing up database")
-					database.backup()
-					last_backup = datetime.utcnow()
-				except Exception as err:
-					utils.process_error(f"Error backing up database", err, traceback.format_exc())
-
-		except Exception as err:
-			utils.process_error(f"Hit an error in main loop", err, traceback.format_exc())
-
-		delta_time = time.perf_counter() - loop_time
-		counters.loop_time.observe(round(delta_time, 2))
-
-		log.debug("Run complete after: %d", int(delta_time))
 
-		database.session.commit()
-		discord_logging.flush_discord()
-		if args.once:
-			break
+def run_modqueue(subreddit, database, reapprove=False):
+	subreddit.clear_modqueue()
+	shared.process_modqueue(subreddit, database, reapprove=reapprove)
+	utils.flush_usernotes(subreddit, database)
+
+
+def run_queues(subreddit, database):
+	subreddit.clear_queue_counts()
+	subreddit.expire_modqueue(timedelta(minutes=1))
+	shared.count_queues(subreddit, database)
+	shared.ping_queues(subreddit, database)
+
+
+def run_shared(subreddit, database):
+	shared.ingest_log(subreddit, database)
+	shared.sync_modmail(subreddit, database)
+	shared.post_overlapping_actions(subreddit, database)
+	shared.log_highlighted_modmail(subreddit, database, start_time)
+
+
+def run_comp_ow(subreddit, database):
+	run_shared(subreddit, database)
+
+	shared.log_archived_modmail_no_response(subreddit, database, start_time)
+
+	compow.process_submissions(subreddit)
+	compow.parse_modmail(subreddit, database)
+
+	utils.flush_usernotes(subreddit, database)
+
+
+def run_bay_area(subreddit, database):
+	run_shared(subreddit, database)
+
+	bayarea.ingest_submissions(subreddit, database)
+	bayarea.ingest_comments(subreddit, database)
+	bayarea.recheck_deferred_comments(subreddit, database)
+	bayarea.check_flair_changes(subreddit, database)
+	bayarea.check_messages(subreddit, database)
+
+	utils.flush_usernotes(subreddit, database)
+
+
+def modqueue_interval(subreddit):
+	# every 15 seconds while there's plenty of the api window left, backing off to the old once a minute as it runs low
+	return functools.partial(budget.interval, subreddit.reddit, 15, 60)
+
 
-		time.sleep(1 * 60)
+def budget_check(subreddit, cost, task):
+	# low priority tasks skip a run rather than eat into the requests kept back for moderation
+	return functools.partial(budget.request, subreddit.reddit, cost, task)
+
+
+def add_comp_ow_tasks(scheduler, subreddit, database):
+	scheduler.add("CompetitiveOverwatch:modqueue", functools.partial(run_modqueue, subreddit, database, reapprove=True), modqueue_interval(subreddit), priority=0, budget=10)
+	scheduler.add("CompetitiveOverwatch:activity", functools.partial(run_comp_ow, subreddit, database), 60, priority=1, budget=30)
+	scheduler.add(
+		"CompetitiveOverwatch:queues", functools.partial(run_queues, subreddit, database), 3 * 60, priority=2, budget=10,
+		check=budget_check(subreddit, 3, "CompetitiveOverwatch:queues"))
+
+
+def add_bay_area_tasks(scheduler, subreddit, database):
+	scheduler.add(
+		"bayarea:approved", functools.partial(shared.update_approved, subreddit), 15 * 60, priority=0, budget=10,
+		check=budget_check(subreddit, 5, "bayarea:approved"))
+	scheduler.add("bayarea:modqueue", functools.partial(run_modqueue, subreddit, database), modqueue_interval(subreddit), priority=0, budget=10)
+	scheduler.add("bayarea:activity", functools.partial(run_bay_area, subreddit, database), 60, priority=1, budget=30)
+	scheduler.add(
+		"bayarea:queues", functools.partial(run_queues, subreddit, database), 3 * 60, priority=2, budget=10,
+		check=budget_check(subreddit, 3, "bayarea:queues"))
+	scheduler.add("bayarea:backfill_karma", functools.partial(bayarea.backfill_karma, subreddit, database), 5 * 60, priority=3, budget=30)
+
+
+def add_maintenance_tasks(scheduler, database):
+	scheduler.add("object_counts", database.update_object_counts, 10 * 60, priority=5, budget=30)
+	scheduler.add("purge", database.purge, 24 * 60 * 60, priority=6, budget=5 * 60)
+	scheduler.add("backup", database.backup, 24 * 60 * 60, priority=7, budget=5 * 60)
+
+
+async def run_serial(praw_file, once):
+	database = init_database()
+	instances = await asyncio.to_thread(login)
+	scheduler = Scheduler("main", after_task=database.commit, after_pass=notifications.flush_discord, whole_loop=True)
+	add_comp_ow_tasks(scheduler, await asyncio.to_thread(build_comp_ow, instances, praw_file), database)
+	add_bay_area_tasks(scheduler, await asyncio.to_thread(build_bay_area, instances, praw_file), database)
+	add_maintenance_tasks(scheduler, database)
+	scheduler.add("api_budget", budget.update, 15, priority=9)
+
+	await scheduler.run(once)
+
+
+async def run_worker(add_tasks, builder, praw_file, once):
+	# each worker gets its own database session and reddit instances, so nothing is shared between threads. the workers
+	# still share the sqlite file, so each commits before its reddit requests rather than holding the write lock over them
+	database = init_database()
+	instances = await asyncio.to_thread(login)
+	subreddit = await asyncio.to_thread(builder, instances, praw_file)
+	scheduler = Scheduler(
+		subreddit.name,
+		after_task=database.commit,
+		after_pass=notifications.flush_discord,
+		before_request=database.release_write_lock)
+	add_tasks(scheduler, subreddit, database)
+
+	await scheduler.run(once)
+
+
+async def run_maintenance_worker(once):
+	database = init_database()
+	scheduler = Scheduler("maintenance", after_task=database.commit)
+	add_maintenance_tasks(scheduler, database)
+	# workers all run in this process, so this one task covers every account
+	scheduler.add("api_budget", budget.update, 15, priority=9)
+
+	await scheduler.run(once)
+
+
+async def run_concurrent(praw_file, once):
+	await asyncio.gather(
+		run_worker(add_comp_ow_tasks, build_comp_ow, praw_file, once),
+		run_worker(add_bay_area_tasks, build_bay_area, praw_file, once),
+		run_maintenance_worker(once),
+	)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="modqueue bot")
+	parser.add_argument("--once", help="Only run the loop once", action='store_const', const=True, default=False)
+	parser.add_argument("--debug", help="Set the log level to debug", action='store_const', const=True, default=False)
+	parser.add_argument("--concurrent", help="Run each subreddit in its own worker", action='store_const', const=True, default=False)
+	parser.add_argument("--record", help="Append every reddit api response to this file, for scripts/replay_benchmark.py")
+	args = parser.parse_args()
+	record_file = args.record
+
+	if args.debug:
+		discord_logging.set_level(logging.DEBUG)
+
+	praw_file = discord_logging.get_config()
+	discord_logging.init_discord_logging("QueueBot", logging.WARNING, 1, logging_webhook=discord_logging.get_config_var(praw_file, "global", 'queue_webhook'))
+
+	log.info(f"Python version {sys.version}")
+
+	counters.init(8003)
+
+	if args.concurrent:
+		asyncio.run(run_concurrent(praw_file, args.once))
+	else:
+		asyncio.run(run_serial(praw_file, args.once))
+	notifications.stop()
 
 
 # turn on:
@@ -194,5 +281,3 @@ if __name__ == "__main__":
 # remove posts from authors with insufficient history
 # warning on flair change during rescan
 # new comment/submission report processing
-
-
@@ -0,0 +1,118 @@
+import queue
+import threading
+import time
+import requests
+import discord_logging
+
+log = discord_logging.get_logger()
+
+import counters
+
+# messages for the same webhook that arrive within this many seconds of each other go out as one post
+merge_window = 2
+max_length = 2000
+max_attempts = 4
+queue_size = 500
+# turned off for offline runs, so nothing reaches the real webhooks
+enabled = True
+
+_queue = queue.Queue(maxsize=queue_size)
+_thread = None
+_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_stop = object()
+
+
+def start():
+	global _thread
+	with _lock:
+		if _thread is None:
+			_thread = threading.Thread(target=_run, name="notifications", daemon=True)
+			_thread.start()
+
+
+def post(webhook, message):
+	if not enabled:
+		counters.notifications.labels(result="disabled").inc()
+		return
+	start()
+	try:
+		_queue.put_nowait((webhook, message))
+	except queue.Full:
+		counters.notifications.labels(result="dropped").inc()
+		log.info(f"Notification queue is full, dropping message: {message[:100]}")
+
+
+def flush_discord():
+	# discord_logging's buffer isn't thread safe, so this runs between tasks like the old loop did rather than on the
+	# notification thread. the lock keeps concurrent workers from flushing at the same time
+	with _flush_lock:
+		discord_logging.flush_discord()
+
+
+def stop(timeout=30):
+	if _thread is not None:
+		_queue.put(_stop)
+		_thread.join(timeout)
+	flush_discord()
+
+
+def merge_messages(items):
+	merged = []
+	by_webhook = {}
+	for webhook, message in items:
+		if webhook in by_webhook and len(by_webhook[webhook][1]) + len(message) + 1 <= max_length:
+			by_webhook[webhook][1] += "\n" + message
+		else:
+			by_webhook[webhook] = [webhook, message]
+			merged.append(by_webhook[webhook])
+	return merged
+
+
+def send(session, webhook, content):
+	for attempt in range(max_attempts):
+		try:
+			response = session.post(webhook, data={"content": content}, timeout=10)
+			if response.status_code == 429:
+				retry_after = float(response.json().get('retry_after', 1))
+				counters.notifications.labels(result="ratelimited").inc()
+				time.sleep(retry_after)
+				continue
+			if response.status_code >= 500:
+				counters.notifications.labels(result="retried").inc()
+				time.sleep(2 ** attempt)
+				continue
+			counters.notifications.labels(result="sent" if response.ok else "failed").inc()
+			return response.ok
+		except requests.exceptions.RequestException as err:
+			counters.notifications.labels(result="retried").inc()
+			log.info(f"Error sending notification, attempt {attempt + 1}: {err}")
+			time.sleep(2 ** attempt)
+
+	counters.notifications.labels(result="failed").inc()
+	log.info(f"Couldn't send notification after {max_attempts} attempts: {content[:100]}")
+	return False
+
+
+def _run():
+	session = requests.Session()
+	stopping = False
+	while not stopping:
+		items = []
+		try:
+			item = _queue.get(timeout=1)
+			deadline = time.monotonic() + merge_window
+			while True:
+				if item is _stop:
+					stopping = True
+					break
+				items.append(item)
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					break
+				item = _queue.get(timeout=remaining)
+		except queue.Empty:
+			pass
+
+		for webhook, content in merge_messages(items):
+			send(session, webhook, content)
@@ -0,0 +1,52 @@
+import discord_logging
+from concurrent.futures import ThreadPoolExecutor
+
+log = discord_logging.get_logger()
+
+import budget
+import stages
+
+
+class ReadPool:
+	"""Spreads requests over several accounts, one share per account at a time, so every account's rate limit is used in
+	parallel. That's read only requests, and mod actions when all the accounts are mods. The instances are shared with the
+	rest of the bot, which can call them from other threads at the same time, so this relies on LockedReddit to send each
+	instance's requests one at a time"""
+	def __init__(self, instances):
+		self.instances = [reddit for reddit in instances if reddit is not None]
+		self.executor = ThreadPoolExecutor(max_workers=len(self.instances), thread_name_prefix="read")
+
+	def available(self, cost, task):
+		if task is None:
+			return self.instances
+		# deferrable work only goes to accounts that can spare their share of it
+		share = -(-cost // len(self.instances))
+		return [reddit for reddit in self.instances if budget.request(reddit, share, task)]
+
+	def spread(self, func, items, instances=None):
+		# calls func(reddit, item) for every item, each account working through its share in order on its own thread
+		if instances is None:
+			instances = self.instances
+
+		def run(reddit, instance_items):
+			return [func(reddit, item) for item in instance_items]
+
+		futures = [
+			self.executor.submit(stages.wrap_context(run), reddit, items[index::len(instances)])
+			for index, reddit in enumerate(instances)
+		]
+		results = []
+		for future in futures:
+			results.extend(future.result())
+		return results
+
+	def info(self, fullnames, task=None, batch_size=100):
+		batches = [fullnames[index:index + batch_size] for index in range(0, len(fullnames), batch_size)]
+		instances = self.available(len(batches), task)
+		if not len(instances):
+			return None
+
+		results = []
+		for batch_results in self.spread(lambda reddit, batch: list(reddit.info(fullnames=batch)), batches, instances):
+			results.extend(batch_results)
+		return results
@@ -0,0 +1,94 @@
+import json
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlparse
+import requests
+import discord_logging
+
+log = discord_logging.get_logger()
+
+# token requests are never written out, and replay answers them itself
+TOKEN_PATH = "/api/v1/access_token"
+RATELIMIT_HEADERS = ("x-ratelimit-remaining", "x-ratelimit-used", "x-ratelimit-reset")
+# replay always reports a full budget, otherwise prawcore would sleep to spread out requests that aren't real
+REPLAY_HEADERS = {"x-ratelimit-remaining": "1000", "x-ratelimit-used": "0", "x-ratelimit-reset": "600"}
+IGNORED_PARAMS = {"raw_json"}
+
+
+def request_key(method, url, params):
+	path = urlparse(url).path.rstrip('/')
+	if path.endswith('.json'):
+		path = path[:-5]
+	params = sorted((key, str(value)) for key, value in (params or {}).items() if key not in IGNORED_PARAMS and value is not None)
+	return f"{method.upper()} {path} {json.dumps(params)}"
+
+
+def build_response(url, status, body, headers=None):
+	response = requests.Response()
+	response.status_code = status
+	response._content = body.encode()
+	response.url = url
+	response.encoding = "utf-8"
+	response.headers["content-type"] = "application/json; charset=UTF-8"
+	if headers:
+		response.headers.update(headers)
+	return response
+
+
+class RecordingSession(requests.Session):
+	"""A requests session that appends every api response to a jsonl file, for replaying the loop offline"""
+	def __init__(self, location):
+		super().__init__()
+		self.location = location
+		self.lock = threading.Lock()
+
+	def request(self, method, url, params=None, **kwargs):
+		response = super().request(method, url, params=params, **kwargs)
+		if urlparse(url).path.rstrip('/') != TOKEN_PATH:
+			line = json.dumps({
+				'key': request_key(method, url, params),
+				'url': url,
+				'status': response.status_code,
+				'headers': {header: response.headers[header] for header in RATELIMIT_HEADERS if header in response.headers},
+				'body': response.text,
+				'recorded': time.time(),
+			})
+			with self.lock:
+				with open(self.location, 'a', encoding='utf-8') as handle:
+					handle.write(line + "\n")
+		return response
+
+
+class ReplaySession(requests.Session):
+	"""Answers requests from a recording instead of the network. Repeated requests get the recorded responses in
+	order, then keep getting the last one. Anything that wasn't recorded, like a removal the recorded loop didn't
+	make, gets an empty success"""
+	def __init__(self, location):
+		super().__init__()
+		self.responses = defaultdict(list)
+		self.positions = defaultdict(int)
+		self.missing = defaultdict(int)
+		self.lock = threading.Lock()
+		with open(location, encoding='utf-8') as handle:
+			for line in handle:
+				if line.strip():
+					recorded = json.loads(line)
+					self.responses[recorded['key']].append(recorded)
+		log.info(f"Loaded {sum(len(values) for values in self.responses.values())} recorded responses from {location}")
+
+	def request(self, method, url, params=None, **kwargs):
+		if urlparse(url).path.rstrip('/') == TOKEN_PATH:
+			return build_response(url, 200, json.dumps({
+				'access_token': "replay", 'expires_in': 86400, 'scope': "*", 'token_type': "bearer"}))
+
+		key = request_key(method, url, params)
+		with self.lock:
+			recorded = self.responses.get(key)
+			if not recorded:
+				self.missing[key] += 1
+				body = "{}" if method.upper() != "GET" else '{"kind": "Listing", "data": {"children": [], "after": null}}'
+				return build_response(url, 200, body, REPLAY_HEADERS)
+			position = min(self.positions[key], len(recorded) - 1)
+			self.positions[key] += 1
+		return build_response(url, recorded[position]['status'], recorded[position]['body'], REPLAY_HEADERS)
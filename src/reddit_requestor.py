@@ -0,0 +1,62 @@
+import re
+import threading
+import time
+from urllib.parse import urlparse
+import praw
+import prawcore
+import discord_logging
+
+log = discord_logging.get_logger()
+
+import counters
+import stages
+
+# collapse the variable parts of a path, so each api endpoint is one label value
+ENDPOINT_PATTERNS = [
+	(re.compile(r'/r/[^/]+'), '/r/{subreddit}'),
+	(re.compile(r'/(?:user|u)/[^/]+'), '/user/{name}'),
+	(re.compile(r'/comments/[^/]+(?:/[^/]*)?(?:/[^/]+)?'), '/comments/{id}'),
+	(re.compile(r'/api/mod/conversations/(?!bulk|read|unread|subreddits)[^/]+'), '/api/mod/conversations/{id}'),
+	(re.compile(r'/by_id/[^/]+'), '/by_id/{ids}'),
+	(re.compile(r'/wiki/revisions/[^/]+'), '/wiki/revisions/{page}'),
+	(re.compile(r'/wiki/(?!revisions|edit|settings)[^/]+'), '/wiki/{page}'),
+]
+
+
+def normalize_endpoint(url):
+	path = urlparse(url).path.rstrip('/')
+	if path.endswith('.json'):
+		path = path[:-5]
+	for pattern, replacement in ENDPOINT_PATTERNS:
+		path = pattern.sub(replacement, path)
+	return path or '/'
+
+
+class CountingRequestor(prawcore.Requestor):
+	"""Counts every reddit request and its latency by endpoint, and by the stage that was running when it was made"""
+	def request(self, method, url, *args, **kwargs):
+		start_time = time.perf_counter()
+		status = "error"
+		try:
+			response = super().request(method, url, *args, **kwargs)
+			status = str(response.status_code)
+			return response
+		finally:
+			method = method.upper()
+			endpoint = normalize_endpoint(url)
+			subreddit_name, stage_name = stages.current.get()
+			counters.reddit_requests.labels(method=method, endpoint=endpoint, subreddit=subreddit_name, stage=stage_name, status=status).inc()
+			counters.reddit_request_time.labels(method=method, endpoint=endpoint).observe(time.perf_counter() - start_time)
+
+
+class LockedReddit(praw.Reddit):
+	"""Holds a lock around every request, so an instance used from several threads still sends one request at a time
+	and prawcore's rate limiter and session state are only touched by one of them"""
+	def __init__(self, *args, **kwargs):
+		self.request_lock = threading.Lock()
+		super().__init__(*args, **kwargs)
+
+	def request(self, *args, **kwargs):
+		stages.before_request()
+		with self.request_lock:
+			return super().request(*args, **kwargs)
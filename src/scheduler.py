@@ -0,0 +1,104 @@
+import asyncio
+import time
+import traceback
+import discord_logging
+
+log = discord_logging.get_logger()
+
+import counters
+import stages
+import utils
+
+
+class Task:
+	"""Something to run every interval seconds, interval can also be a function that's asked again after every run. When
+	several tasks are due the lowest priority number runs first. Runs are never interrupted, budget is just how long one
+	is expected to take and a run over it is logged. A task with a check is skipped until its next interval whenever the
+	check returns False"""
+	def __init__(self, name, func, interval, priority=10, budget=None, check=None):
+		self.name = name
+		self.func = func
+		self.interval = interval
+		self.priority = priority
+		self.budget = budget
+		self.check = check
+		self.next_run = 0
+
+	def is_due(self, now):
+		return self.next_run <= now
+
+	def get_interval(self):
+		return self.interval() if callable(self.interval) else self.interval
+
+
+class Scheduler:
+	def __init__(self, name, after_task=None, after_pass=None, whole_loop=False, before_request=None):
+		self.name = name
+		self.tasks = []
+		self.after_task = after_task
+		self.after_pass = after_pass
+		# called before any reddit request a task makes from its own thread, see stages.hook_requests
+		self.before_request = before_request
+		# only a scheduler running every task reports the overall loop time, concurrent workers each cover a part of it
+		self.whole_loop = whole_loop
+
+	def add(self, name, func, interval, priority=10, budget=None, check=None):
+		task = Task(name, func, interval, priority, budget, check)
+		self.tasks.append(task)
+		return task
+
+	def call_task(self, func):
+		if self.before_request is None:
+			return func()
+		with stages.hook_requests(self.before_request):
+			return func()
+
+	async def run_task(self, task):
+		start_time = time.perf_counter()
+		task.next_run = time.monotonic() + task.get_interval()
+		if task.check is not None and not task.check():
+			return 0
+		subreddit_name, _, stage_name = task.name.rpartition(":")
+		try:
+			with stages.stage(subreddit_name, stage_name):
+				await asyncio.to_thread(self.call_task, task.func)
+		except Exception as err:
+			utils.process_error(f"Hit an error in task {task.name}", err, traceback.format_exc())
+
+		if self.after_task is not None:
+			await asyncio.to_thread(self.after_task)
+
+		delta_time = time.perf_counter() - start_time
+		counters.task_time.labels(task=task.name).observe(round(delta_time, 2))
+		if task.budget is not None and delta_time > task.budget:
+			log.info(f"Task {task.name} took {delta_time:.2f} seconds, over its budget of {task.budget}")
+		else:
+			log.debug(f"Task {task.name} complete after: {delta_time:.2f}")
+		return delta_time
+
+	async def run_pass(self):
+		now = time.monotonic()
+		due_tasks = sorted((task for task in self.tasks if task.is_due(now)), key=lambda task: task.priority)
+		subreddit_times = {}
+		for task in due_tasks:
+			delta_time = await self.run_task(task)
+			subreddit_name, _, _ = task.name.rpartition(":")
+			if subreddit_name:
+				subreddit_times[subreddit_name] = subreddit_times.get(subreddit_name, 0) + delta_time
+		for subreddit_name, delta_time in subreddit_times.items():
+			counters.subreddit_loop_time.labels(subreddit=subreddit_name).observe(round(delta_time, 2))
+		return len(due_tasks)
+
+	async def run(self, once=False):
+		while True:
+			loop_time = time.perf_counter()
+			if await self.run_pass():
+				if self.whole_loop:
+					counters.loop_time.observe(round(time.perf_counter() - loop_time, 2))
+				if self.after_pass is not None:
+					await asyncio.to_thread(self.after_pass)
+			if once:
+				break
+
+			next_run = min(task.next_run for task in self.tasks)
+			await asyncio.sleep(max(next_run - time.monotonic(), 0.5))
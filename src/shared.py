@@ -11,19 +11,26 @@ from sqlalchemy.sql import func, text
 log = discord_logging.get_logger()
 
 import counters
+import stages
 import utils
 import static
+import notifications
 from database import LogItem, Comment, User, Submission
 from classes import UserNotes, Note
 
 
+@stages.timed
 def ingest_log(subreddit, database):
 	subreddit.mod_log = []
+	cursor = database.get_log_cursor(subreddit.case_sensitive_name)
+	rows = []
 	for log_item in subreddit.sub_object.mod.log(limit=None):
-		if database.session.query(LogItem).filter_by(id=log_item.id).count() > 0:
+		row = LogItem.to_row(log_item)
+		if cursor is not None and (row['id'] == cursor.log_id or row['created'] < cursor.created):
 			break
 
 		subreddit.mod_log.append(log_item)
+		rows.append(row)
 
 		counters.mod_actions.labels(moderator=log_item.mod.name, subreddit=subreddit.name).inc()
 
@@ -88,148 +95,179 @@ def ingest_log(subreddit, database):
 			log.warning(
 				f"r/{subreddit.name}: {warning_type}:Mod action by u/{log_item.mod.name}: {log_item.action} {' '.join(warning_items)}")
 
-		database.session.merge(LogItem(log_item))
-	discord_logging.flush_discord()
+	if len(rows):
+		database.add_log_items(rows)
+		database.set_log_cursor(subreddit.case_sensitive_name, rows[0]['id'], rows[0]['created'])
+	notifications.flush_discord()
 
 
+@stages.timed
 def update_approved(subreddit):
 	subreddit.approved = []
 	for contributor in subreddit.sub_object.contributor():
 		subreddit.approved.append(contributor.name)
 
 
-def process_modqueue_reapprove(subreddit):
-	for item in list(subreddit.modqueue()):
-		if item.approved:
-			approve = True
-			if len(subreddit.reapprove_reasons):
-				for report in item.user_reports:
-					if report[0] not in subreddit.reapprove_reasons:
-						approve = False
-						break
-
-			if approve:
-				log.info(f"Reapproving item: {item.id}")
-				item.mod.approve()
-				subreddit.modqueue().remove(item)
-
-
-def process_modqueue_old(subreddit):
-	for item in list(subreddit.modqueue()):
-		item_date = datetime.utcfromtimestamp(item.created_utc)
-		if item_date < datetime.utcnow() - timedelta(days=180):
-			log.info(f"r/{subreddit.name}: [Old item in modqueue](https://www.reddit.com/{item.permalink}), automatically removing")
-			item.mod.remove()
-
+def process_modqueue_reapprove(subreddit, item):
+	if len(subreddit.reapprove_reasons):
+		for report in item.user_reports:
+			if report[0] not in subreddit.reapprove_reasons:
+				return False
+
+	log.info(f"Reapproving item: {item.id}")
+	item.mod.approve()
+	return True
+
+
+def process_modqueue_old(subreddit, item):
+	log.info(f"r/{subreddit.name}: [Old item in modqueue](https://www.reddit.com/{item.permalink}), automatically removing")
+	item.mod.remove()
+	return True
+
+
+def modqueue_fingerprint(item):
+	return (
+		item.fullname,
+		tuple(tuple(report) for report in item.mod_reports),
+		tuple(tuple(report) for report in item.user_reports),
+		item.approved,
+	)
+
+
+@stages.timed
+def process_modqueue(subreddit, database, reapprove=False):
+	# classify each item once and hand it to the first handler that applies. report handlers only see items that
+	# are new or changed since the last loop, items that leave the queue drop out of the fingerprints
+	old_date = datetime.utcnow() - timedelta(days=180)
+	fingerprints = {}
+	new_items = 0
+	for item in subreddit.modqueue():
+		fingerprint = modqueue_fingerprint(item)
+		changed = subreddit.modqueue_fingerprints.get(item.fullname) != fingerprint
+		handled = False
+		if changed:
+			new_items += 1
+			if len(item.mod_reports):
+				if item.fullname.startswith("t1_"):
+					handled = process_modqueue_comment_v2(subreddit, database, item)
+				elif item.fullname.startswith("t3_") and subreddit.rules is not None:
+					handled = process_modqueue_submission_v2(subreddit, item)
+		if not handled and datetime.utcfromtimestamp(item.created_utc) < old_date:
+			handled = process_modqueue_old(subreddit, item)
+		if not handled and changed and reapprove and item.approved:
+			handled = process_modqueue_reapprove(subreddit, item)
+
+		if handled:
+			subreddit.modqueue_handled.add(item.fullname)
+		else:
+			fingerprints[item.fullname] = fingerprint
+
+	subreddit.modqueue_fingerprints = fingerprints
+	counters.modqueue_new_items.labels(subreddit=subreddit.name).set(new_items)
+	if new_items:
+		log.debug(f"r/{subreddit.name}: {new_items} new or changed modqueue items")
+
+
+def process_modqueue_comment_v2(subreddit, database, item):
+	for report_reason, mod_name in item.mod_reports:
+		report_split = report_reason.split(" ")
+		days = None
+		action_string = "error, invalid action"
+		additional_note = None
+
+		rule = subreddit.rules.get(report_reason)
+		if rule is None:
+			rule = subreddit.rules_by_number.get(report_split[0].lower())
+			if rule is not None:
+				if len(report_split) > 1:
+					if report_split[1] == 'w':
+						log.info(f"Processing new warning comment report: {report_reason}")
+						days = 0
+						action_string = "warned"
+					elif report_split[1] == 'p':
+						log.info(f"Processing new permaban comment report: {report_reason}")
+						days = -1
+						action_string = "permabanned"
+					else:
+						try:
+							days = int(report_split[1])
+							log.info(f"Processing new {days} day ban comment report: {report_reason}")
+							action_string = f"banned for {days} days"
+						except ValueError:
+							additional_note = ' '.join(report_split[1:])
+							pass
+
+				if additional_note is None and len(report_split) > 2:
+					additional_note = ' '.join(report_split[2:])
+
+		if rule is None:
+			continue
+		if rule.comment_text is None or rule.short_text is None:
+			log.info(f"Mod report by u/{mod_name} doesn't match a valid rule: {report_reason}")
+			continue
+
+		sub_notes = utils.get_usernotes(subreddit, database)
+		username = item.author.name
+		user_note = sub_notes.get_user_note(username)
+		if user_note is not None:
+			days_ban, note_is_old, note_created = user_note.get_recent_warn_ban()
+			log.info(f"Processing new comment report: {report_reason}. Got {days_ban} days ban from notes")
+		else:
+			days_ban, note_is_old, note_created = None, False, None
+			log.info(f"Processing new comment report: {report_reason}. No usernotes")
 
-def process_modqueue_comments_v2(subreddit):
-	for item in list(subreddit.modqueue()):
-		if item.fullname.startswith("t1_") and len(item.mod_reports):
-			for report_reason, mod_name in item.mod_reports:
-				report_split = report_reason.split(" ")
-				days = None
-				action_string = "error, invalid action"
-				additional_note = None
-
-				rule = subreddit.rules.get(report_reason)
-				if rule is None:
-					rule = subreddit.rules_by_number.get(report_split[0].lower())
-					if rule is not None:
-						if len(report_split) > 1:
-							if report_split[1] == 'w':
-								log.info(f"Processing new warning comment report: {report_reason}")
-								days = 0
-								action_string = "warned"
-							elif report_split[1] == 'p':
-								log.info(f"Processing new permaban comment report: {report_reason}")
-								days = -1
-								action_string = "permabanned"
-							else:
-								try:
-									days = int(report_split[1])
-									log.info(f"Processing new {days} day ban comment report: {report_reason}")
-									action_string = f"banned for {days} days"
-								except ValueError:
-									additional_note = ' '.join(report_split[1:])
-									pass
-
-						if additional_note is None and len(report_split) > 2:
-							additional_note = ' '.join(report_split[2:])
-
-				if rule is None:
-					continue
-				if rule.comment_text is None or rule.short_text is None:
-					log.info(f"Mod report by u/{mod_name} doesn't match a valid rule: {report_reason}")
-					continue
+		if note_created is not None and note_created > datetime.utcfromtimestamp(item.created_utc):
+			log.info(f"This item was created before the most recent note, skipping ban")
+			subreddit.post_to_discord(f"{subreddit.get_discord_name(mod_name)}: The [comment you reported](<https://www.reddit.com{item.permalink}>) was posted before their most recent warn/ban. To avoid double banning I am only removing the comment.")
 
-				sub_notes = utils.get_usernotes(subreddit)
-				username = item.author.name
-				user_note = sub_notes.get_user_note(username)
-				if user_note is not None:
-					days_ban, note_is_old, note_created = user_note.get_recent_warn_ban()
-					log.info(f"Processing new comment report: {report_reason}. Got {days_ban} days ban from notes")
+		else:
+			if days is None:
+				days = subreddit.get_next_ban_tier(days_ban, note_is_old)
+				if days == -1:
+					action_string = "permabanned based on usernotes"
+				elif days == 0:
+					action_string = "warned based on usernotes"
 				else:
-					days_ban, note_is_old, note_created = None, False, None
-					log.info(f"Processing new comment report: {report_reason}. No usernotes")
-
-				if note_created is not None and note_created > datetime.utcfromtimestamp(item.created_utc):
-					log.info(f"This item was created before the most recent note, skipping ban")
-					subreddit.post_to_discord(f"{subreddit.get_discord_name(mod_name)}: The [comment you reported](<https://www.reddit.com{item.permalink}>) was posted before their most recent warn/ban. To avoid double banning I am only removing the comment.")
-
+					action_string = f"banned for {days} days based on usernotes"
+
+			item_link = f"https://www.reddit.com{item.permalink}"
+			reason_text = rule.comment_text
+			if additional_note is not None:
+				reason_text = reason_text + "\n\n" + additional_note
+			warn_ban_message = f"{reason_text}\n\n{item_link}"
+			if subreddit.name_in_modmails:
+				warn_ban_message += f"\n\nFrom u/{mod_name}"
+			if days == 0:
+				log.info(f"Warning u/{username}, rule {rule.rule_number} from u/{mod_name}")
+				utils.warn_archive(item.author, subreddit, database, f"Rule {rule.rule_number} warning", warn_ban_message)
+				note_type, note_text = "abusewarn", rule.short_text
+			else:
+				if days == -1:
+					log.warning(f"Banning u/{username} permanently, rule {rule.rule_number} from u/{mod_name}")
+					subreddit.sub_object.banned.add(
+						item.author,
+						ban_reason=f"{rule.short_text} u/{mod_name}",
+						ban_message=warn_ban_message)
+					note_type, note_text = "permban", rule.short_text
 				else:
-					if days is None:
-						days = subreddit.get_next_ban_tier(days_ban, note_is_old)
-						if days == -1:
-							action_string = "permabanned based on usernotes"
-						elif days == 0:
-							action_string = "warned based on usernotes"
-						else:
-							action_string = f"banned for {days} days based on usernotes"
+					log.info(f"Banning u/{username} for {days} days, rule {rule.rule_number} from u/{mod_name}")
+					subreddit.sub_object.banned.add(
+						item.author,
+						duration=days,
+						ban_reason=f"{rule.short_text} u/{mod_name}",
+						ban_message=warn_ban_message)
+					note_type, note_text = "ban", f"{days}d - {rule.short_text}"
 
-					item_link = f"https://www.reddit.com{item.permalink}"
-					reason_text = rule.comment_text
-					if additional_note is not None:
-						reason_text = reason_text + "\n\n" + additional_note
-					warn_ban_message = f"{reason_text}\n\n{item_link}"
-					if subreddit.name_in_modmails:
-						warn_ban_message += f"\n\nFrom u/{mod_name}"
-					if days == 0:
-						log.info(f"Warning u/{username}, rule {rule.rule_number} from u/{mod_name}")
-						utils.warn_archive(item.author, subreddit, f"Rule {rule.rule_number} warning", warn_ban_message)
-						note = Note.build_note(sub_notes, mod_name, "abusewarn", rule.short_text, datetime.utcnow(), item_link)
-					else:
-						if days == -1:
-							log.warning(f"Banning u/{username} permanently, rule {rule.rule_number} from u/{mod_name}")
-							subreddit.sub_object.banned.add(
-								item.author,
-								ban_reason=f"{rule.short_text} u/{mod_name}",
-								ban_message=warn_ban_message)
-							note = Note.build_note(sub_notes, mod_name, "permban", rule.short_text, datetime.utcnow(), item_link)
-						else:
-							log.info(f"Banning u/{username} for {days} days, rule {rule.rule_number} from u/{mod_name}")
-							subreddit.sub_object.banned.add(
-								item.author,
-								duration=days,
-								ban_reason=f"{rule.short_text} u/{mod_name}",
-								ban_message=warn_ban_message)
-							note = Note.build_note(sub_notes, mod_name, "ban", f"{days}d - {rule.short_text}", datetime.utcnow(), item_link)
+			utils.add_usernote(subreddit, database, username, mod_name, note_type, note_text, item_link)
 
-					if user_note is not None:
-						user_note.add_new_note(note)
-					else:
-						user_note = UserNotes(username)
-						user_note.add_new_note(note)
-						sub_notes.add_update_user_note(user_note)
-					utils.save_usernotes(subreddit, sub_notes, f"\"create new note on user {username}\" via {subreddit.get_account_name()}")
+		count_removed = utils.recursive_remove_comments(subreddit, item)
+		if count_removed > 1:
+			log.info(f"Recursively removed {count_removed} comments")
 
-				count_removed = utils.recursive_remove_comments(item)
-				if count_removed > 1:
-					log.info(f"Recursively removed {count_removed} comments")
+		log.info(f"r/{subreddit.name}:u/{mod_name}: u/{username} {action_string}")
 
-				log.info(f"r/{subreddit.name}:u/{mod_name}: u/{username} {action_string}")
-
-				subreddit.modqueue().remove(item)
-				break
+		return True
+	return False
 
 
 def process_modqueue_comments(subreddit):
@@ -335,7 +373,7 @@ def process_modqueue_comments(subreddit):
 						sub_notes.add_update_user_note(user_note)
 					utils.save_usernotes(subreddit, sub_notes, f"\"create new note on user {username}\" via {subreddit.get_account_name()}")
 
-					count_removed = utils.recursive_remove_comments(item)
+					count_removed = utils.recursive_remove_comments(subreddit, item)
 					if count_removed > 1:
 						log.info(f"Recursively removed {count_removed} comments")
 
@@ -345,28 +383,25 @@ def process_modqueue_comments(subreddit):
 					break
 
 
-def process_modqueue_submissions_v2(subreddit):
-	for item in list(subreddit.modqueue()):
-		if subreddit.rules is not None and item.fullname.startswith("t3_") and len(item.mod_reports):
-			for report_reason, mod_name in item.mod_reports:
-				rule = subreddit.rules.get(report_reason)
-				if rule is not None:
-					if rule.post_text is None:
-						log.warning(f"[Post](<https://www.reddit.com/r/{subreddit.name}/comments/{item.id}/>) reported for rule {rule.rule_number}, but that rule doesn't have a post text")
-						continue
+def process_modqueue_submission_v2(subreddit, item):
+	for report_reason, mod_name in item.mod_reports:
+		rule = subreddit.rules.get(report_reason)
+		if rule is not None:
+			if rule.post_text is None:
+				log.warning(f"[Post](<https://www.reddit.com/r/{subreddit.name}/comments/{item.id}/>) reported for rule {rule.rule_number}, but that rule doesn't have a post text")
+				continue
 
-					log.info(f"Removing post {item.id} for rule {rule.rule_number} from u/{mod_name}")
-					item.mod.remove()
-					item.mod.lock()
-					item.mod.flair("Removed")
-					subreddit.modqueue().remove(item)
-
-					comment = item.reply(
-						f"{static.REMOVAL_REASON_HEADER.format(subreddit.name)}\n\n{rule.post_text}\n\n"
-						f"{static.REMOVAL_REASON_FOOTER.format(subreddit.name)}\n\nTriggered by mod {mod_name}")
-					comment.mod.distinguish(how="yes", sticky=True)
+			log.info(f"Removing post {item.id} for rule {rule.rule_number} from u/{mod_name}")
+			item.mod.remove()
+			item.mod.lock()
+			item.mod.flair("Removed")
 
-					break
+			comment = item.reply(
+				f"{static.REMOVAL_REASON_HEADER.format(subreddit.name)}\n\n{rule.post_text}\n\n"
+				f"{static.REMOVAL_REASON_FOOTER.format(subreddit.name)}\n\nTriggered by mod {mod_name}")
+			comment.mod.distinguish(how="yes", sticky=True)
+			return True
+	return False
 
 
 def process_modqueue_submissions(subreddit):
@@ -389,19 +424,30 @@ def process_modqueue_submissions(subreddit):
 					break
 
 
-def log_highlighted_modmail(subreddit, start_time):
-	for conversation in subreddit.all_modmail():
-		if utils.conversation_is_unread(conversation):
-			conversation_type = None
-			if len([author for author in conversation.authors if author.is_admin]) > 0:
-				conversation_type = "Admin"
-			elif conversation.is_highlighted:
-				conversation_type = "Highlighted"
-			if conversation_type is not None and utils.conversation_not_processed(
-					conversation, subreddit.processed_modmails, start_time):
-				log.warning(
-					f"r/{subreddit.name}: {conversation_type} modmail has a new reply: https://mod.reddit.com/mail/all/{conversation.id}")
-				subreddit.processed_modmails[conversation.id] = utils.parse_modmail_datetime(conversation.last_updated)
+@stages.timed
+def sync_modmail(subreddit, database, full_sync_minutes=10):
+	# the incremental passes stop at the last_updated cursor, and highlighting or reading a conversation doesn't change
+	# last_updated, so those changes are only picked up by the full pass. they can be up to full_sync_minutes stale
+	sync_time = datetime.utcnow()
+	full_sync = subreddit.modmail_synced is None or subreddit.modmail_synced < sync_time - timedelta(minutes=full_sync_minutes)
+	for state, limit in (('all', None), ('appeals', None), ('archived', 100)):
+		utils.sync_modmail_state(subreddit, database, state, limit, sync_time, incremental=not full_sync or state == 'archived')
+
+	if full_sync:
+		closed = database.close_missing_modmail(subreddit.name, ('all', 'appeals'), sync_time)
+		if closed:
+			log.debug(f"r/{subreddit.name}: Closed {closed} modmails missing from the full sync")
+		subreddit.modmail_synced = sync_time
+
+
+@stages.timed
+def log_highlighted_modmail(subreddit, database, start_time):
+	for conversation in database.get_unread_flagged_modmail(subreddit.name, start_time):
+		conversation_type = "Admin" if conversation.is_admin else "Highlighted"
+		if utils.conversation_not_processed(conversation, subreddit.processed_modmails, start_time):
+			log.warning(
+				f"r/{subreddit.name}: {conversation_type} modmail has a new reply: https://mod.reddit.com/mail/all/{conversation.id}")
+			subreddit.processed_modmails[conversation.id] = conversation.last_updated
 
 
 def ignore_modmail_requests(subreddit):
@@ -420,29 +466,30 @@ https://www.reddit.com/r/Save3rdPartyApps/comments/13yh0jf/dont_let_reddit_kill_
 			conversation.archive()
 
 
-def log_archived_modmail_no_response(subreddit, start_time):
-	for conversation in subreddit.archived_modmail():
+@stages.timed
+def log_archived_modmail_no_response(subreddit, database, start_time):
+	for conversation in database.get_recent_archived_modmail(subreddit.name):
 		if conversation.last_user_update is not None and \
-				(conversation.last_mod_update is None or utils.parse_modmail_datetime(
-					conversation.last_mod_update) < utils.parse_modmail_datetime(
-					conversation.last_user_update)) and \
+				(conversation.last_mod_update is None or conversation.last_mod_update < conversation.last_user_update) and \
 				utils.conversation_not_processed(conversation, subreddit.processed_modmails, start_time):
-			archived_by = conversation.mod_actions[-1].author.name
+			archived_by = conversation.last_action_by
+			if archived_by is None:
+				# the synced listing doesn't include mod actions, so only the few conversations that get this far are fetched
+				mod_actions = subreddit.sub_object.modmail(conversation.id).mod_actions
+				if len(mod_actions) and mod_actions[-1].author is not None:
+					archived_by = mod_actions[-1].author.name
 			if archived_by != "Watchful1":
 				log.warning(
 					f"Modmail archived without reply: https://mod.reddit.com/mail/arvhiced/{conversation.id} by u/{archived_by}")
-			subreddit.processed_modmails[conversation.id] = utils.parse_modmail_datetime(conversation.last_updated)
+			subreddit.processed_modmails[conversation.id] = conversation.last_updated
 
 
-def count_queues(subreddit):
+@stages.timed
+def count_queues(subreddit, database):
 	if subreddit.thresholds['modmail']['track']:
-		oldest_modmail = datetime.utcnow()
-		for conversation in subreddit.combined_modmail():
-			if not conversation.is_highlighted:
-				subreddit.mail_count += 1
-				modmail_age = utils.parse_modmail_datetime(conversation.last_updated)
-				if modmail_age < oldest_modmail:
-					oldest_modmail = modmail_age
+		subreddit.mail_count, oldest_modmail = database.get_modmail_queue(subreddit.name)
+		if oldest_modmail is None:
+			oldest_modmail = datetime.utcnow()
 
 		subreddit.oldest_modmail_hours = math.trunc((datetime.utcnow() - oldest_modmail).total_seconds() / (60 * 60))
 
@@ -451,7 +498,7 @@ def count_queues(subreddit):
 
 	if subreddit.thresholds['unmod']['track']:
 		oldest_unmod = datetime.utcnow()
-		for submission in subreddit.sub_object.mod.unmoderated():
+		for submission in subreddit.unmoderated():
 			subreddit.unmod_count += 1
 			oldest_unmod = datetime.utcfromtimestamp(submission.created_utc)
 			subreddit.oldest_unmod_link = f"https://www.reddit.com{submission.permalink}"
@@ -462,7 +509,7 @@ def count_queues(subreddit):
 		counters.queue_size.labels(type='unmod_hours', subreddit=subreddit.name).set(subreddit.oldest_unmod_hours)
 
 	if subreddit.thresholds['modqueue']['track']:
-		subreddit.reported_count = len(list(subreddit.sub_object.mod.modqueue(limit=None)))
+		subreddit.reported_count = len([item for item in subreddit.modqueue() if item.fullname not in subreddit.modqueue_handled])
 
 		counters.queue_size.labels(type='modqueue', subreddit=subreddit.name).set(subreddit.reported_count)
 
@@ -472,6 +519,7 @@ def count_queues(subreddit):
 		f"modmail hours: {subreddit.oldest_modmail_hours}")
 
 
+@stages.timed
 def ping_queues(subreddit, database):
 	count_string = subreddit.ping_string()
 
@@ -510,6 +558,7 @@ def ping_queues(subreddit, database):
 			subreddit.has_posted = False
 
 
+@stages.timed
 def post_overlapping_actions(subreddit, database):
 	result = database.session.execute(text(f'''
 select l1.mod, l1.action, l2.mod, l2.action, l1.target_fullname, l1.target_permalink
@@ -0,0 +1,96 @@
+import contextvars
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from sqlalchemy import event
+import discord_logging
+
+log = discord_logging.get_logger()
+
+import counters
+
+# queries slower than this get logged along with their query plan
+slow_query_seconds = 0.5
+
+# (subreddit, stage) for whatever is running right now. asyncio.to_thread copies it into the worker thread, so
+# anything a task calls is attributed to that task
+current = contextvars.ContextVar('stage', default=("none", "none"))
+
+
+@contextmanager
+def stage(subreddit_name, stage_name):
+	token = current.set((subreddit_name or "none", stage_name))
+	start_time = time.perf_counter()
+	try:
+		yield
+	finally:
+		counters.stage_time.labels(subreddit=subreddit_name or "none", stage=stage_name).observe(time.perf_counter() - start_time)
+		current.reset(token)
+
+
+def timed(func):
+	# for functions that take the subreddit as their first argument
+	@functools.wraps(func)
+	def wrapper(subreddit, *args, **kwargs):
+		with stage(subreddit.name, func.__name__):
+			return func(subreddit, *args, **kwargs)
+	return wrapper
+
+
+# set while a task runs, so a reddit request made on that task's own thread can call it first. concurrent workers use
+# this to commit their database writes, since sqlite holds the write lock from a transaction's first write to its commit
+request_hook = contextvars.ContextVar('request_hook', default=None)
+
+
+@contextmanager
+def hook_requests(func):
+	token = request_hook.set((func, threading.get_ident()))
+	try:
+		yield
+	finally:
+		request_hook.reset(token)
+
+
+def before_request():
+	# executor threads fanned out from the task get a copy of the context too, but they don't own its database session
+	hook = request_hook.get()
+	if hook is not None and hook[1] == threading.get_ident():
+		hook[0]()
+
+
+def wrap_context(func):
+	# executor threads don't inherit the context on their own. each call gets its own copy, since a context can't be
+	# entered by two threads at once
+	context = contextvars.copy_context()
+	return lambda *args, **kwargs: context.copy().run(func, *args, **kwargs)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+	# kept on the statement's own context, so a query that raises can't leave a start time behind for the next one
+	context._query_start = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+	delta_time = time.perf_counter() - context._query_start
+	subreddit_name, stage_name = current.get()
+	counters.sql_queries.labels(subreddit=subreddit_name, stage=stage_name).inc()
+	counters.sql_time.labels(subreddit=subreddit_name, stage=stage_name).inc(delta_time)
+
+	if delta_time > slow_query_seconds:
+		counters.sql_slow_queries.labels(subreddit=subreddit_name, stage=stage_name).inc()
+		plan = "unavailable"
+		if not executemany:
+			try:
+				explain_cursor = conn.connection.cursor()
+				explain_cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)
+				plan = " | ".join(str(row[-1]) for row in explain_cursor.fetchall())
+				explain_cursor.close()
+			except Exception as err:
+				plan = f"error: {err}"
+		log.info(f"Slow query in {subreddit_name}:{stage_name} took {delta_time:.2f} seconds: {' '.join(statement.split())} : plan: {plan}")
+
+
+def instrument_engine(engine):
+	event.listen(engine, "before_cursor_execute", before_cursor_execute)
+	event.listen(engine, "after_cursor_execute", after_cursor_execute)
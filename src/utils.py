@@ -12,10 +12,14 @@ import re
 import requests
 import prawcore
 import math
+import functools
 
 log = discord_logging.get_logger()
 
+import counters
+import stages
 from classes import SubredditNotes, UserNotes, Note
+from database import PendingNote
 
 
 def process_error(message, exception, traceback):
@@ -40,80 +44,207 @@ def parse_modmail_datetime(datetime_string):
 		return datetime.strptime(datetime_string, "%Y-%m-%dT%H:%M:%S.%f+0000")
 
 
-def conversation_is_unread(conversation):
-	return conversation.last_unread is not None and parse_modmail_datetime(conversation.last_unread) > \
-				parse_modmail_datetime(conversation.last_updated)
-
-
 def conversation_not_processed(conversation, processed_modmails, start_time):
-	last_replied = parse_modmail_datetime(conversation.last_updated)
+	last_replied = conversation.last_updated
 	return last_replied > start_time and (conversation.id not in processed_modmails or last_replied > processed_modmails[conversation.id])
 
 
-def recursive_remove_comments(comment, count_removed=1):
-	log.debug(f"Recursive removing {comment.id}")
+def parse_optional_modmail_datetime(datetime_string):
+	return parse_modmail_datetime(datetime_string) if datetime_string is not None else None
+
+
+def modmail_to_row(conversation, subreddit_name, state, synced):
+	# only reads what the listing already returned, any other attribute makes praw fetch the whole conversation. the
+	# listing includes the messages when there are few enough, which covers the single message ones we read, and mod
+	# actions only come with a fetched conversation
+	messages = vars(conversation).get('messages') or []
+	mod_actions = vars(conversation).get('mod_actions') or []
+	return {
+		'id': conversation.id,
+		'subreddit': subreddit_name,
+		'state': state,
+		'is_highlighted': bool(conversation.is_highlighted),
+		'is_internal': bool(conversation.is_internal),
+		'is_admin': any(getattr(author, 'is_admin', False) for author in conversation.authors),
+		'last_updated': parse_modmail_datetime(conversation.last_updated),
+		'last_unread': parse_optional_modmail_datetime(conversation.last_unread),
+		'last_user_update': parse_optional_modmail_datetime(conversation.last_user_update),
+		'last_mod_update': parse_optional_modmail_datetime(conversation.last_mod_update),
+		'num_messages': conversation.num_messages,
+		'authors': " ".join(author.name for author in conversation.authors),
+		'first_message': messages[0].body_markdown[:4000] if len(messages) else None,
+		'last_action_by': mod_actions[-1].author.name if len(mod_actions) and mod_actions[-1].author is not None else None,
+		'synced': synced,
+	}
+
+
+@stages.timed
+def recursive_remove_comments(subreddit, comment):
+	start_time = time.perf_counter()
+	# one refresh plus bulk expansion of the collapsed replies gets the whole subtree, including the removed flags
 	comment.refresh()
-	for child_comment in comment.replies:
-		count_removed = recursive_remove_comments(child_comment, count_removed)
+	comment.replies.replace_more(limit=None)
+	# any of the mod accounts can remove the replies, so they're split between them. each account goes through its share
+	# deepest first, and the comment itself is removed once all its replies are gone
+	replies = [child for child in reversed(comment.replies.list()) if not child.removed]
+	subreddit.mod_pool.spread(lambda reddit, child: reddit.comment(child.id).mod.remove(), replies)
+	count_removed = len(replies)
 	if not comment.removed:
 		comment.mod.remove()
 		count_removed += 1
+	log.debug(f"Recursively removed {count_removed} comments under {comment.id} in {time.perf_counter() - start_time:.2f} seconds")
 	return count_removed
 
 
-def get_usernotes(subreddit):
-	json_text = subreddit.sub_object.wiki['usernotes'].content_md
-	return SubredditNotes.from_dict(subreddit.name, json_text)
+def get_usernotes_revision(subreddit):
+	for revision in subreddit.sub_object.wiki['usernotes'].revisions(limit=1):
+		return revision
+	return None
 
 
-def save_usernotes(subreddit, sub_notes, change_reason):
+def get_usernotes(subreddit, database=None):
+	# checking the latest revision is a small listing request, only download and decode the page if it changed
+	revision = get_usernotes_revision(subreddit)
+	if subreddit.usernotes is not None and revision is not None and revision['id'] == subreddit.usernotes_revision:
+		counters.usernotes_cache.labels(subreddit=subreddit.name, result="hit").inc()
+		sub_notes = subreddit.usernotes
+	else:
+		counters.usernotes_cache.labels(subreddit=subreddit.name, result="miss").inc()
+		wiki_page = subreddit.sub_object.wiki['usernotes']
+		sub_notes = SubredditNotes.from_dict(subreddit.name, wiki_page.content_md)
+		subreddit.usernotes = sub_notes
+		subreddit.usernotes_revision = wiki_page.revision_id
+		subreddit.usernotes_pending_ids = set()
+
+	# notes waiting to be saved aren't on the wiki page yet, so add them to whatever we loaded
+	if database is not None:
+		for pending_note in get_pending_notes(subreddit, database):
+			if pending_note.id not in subreddit.usernotes_pending_ids:
+				apply_pending_note(sub_notes, pending_note)
+				subreddit.usernotes_pending_ids.add(pending_note.id)
+	return sub_notes
+
+
+def get_pending_notes(subreddit, database):
+	return database.session.query(PendingNote).filter_by(subreddit=subreddit.name).order_by(PendingNote.id).all()
+
+
+def apply_pending_note(sub_notes, pending_note):
+	sub_notes.add_mod(pending_note.mod)
+	note = Note.build_note(sub_notes, pending_note.mod, pending_note.note_type, pending_note.note_text, pending_note.created, pending_note.permalink)
+	# a save can reach the wiki without its pending rows getting cleared, don't add the same note a second time
+	user_note = sub_notes.get_user_note(pending_note.username)
+	if user_note is not None and any(existing.to_dict() == note.to_dict() for existing in user_note.notes):
+		return
+	sub_notes.add_new_note(pending_note.username, note)
+
+
+def save_usernotes(subreddit, sub_notes, change_reason, previous_revision=None, on_saved=None):
+	# the caller has already changed these notes, so drop the cache until the save is confirmed
+	subreddit.usernotes = None
+	subreddit.usernotes_revision = None
 	json_dict = sub_notes.to_dict()
+	edit_settings = {}
+	if previous_revision is not None:
+		# reddit rejects the edit with a 409 conflict if the page has been changed since this revision
+		edit_settings['previous'] = previous_revision
+	saved = False
 	try:
-		subreddit.sub_object.wiki['usernotes'].edit(json.dumps(json_dict), reason=change_reason)
+		subreddit.sub_object.wiki['usernotes'].edit(content=json.dumps(json_dict), reason=change_reason, **edit_settings)
+		saved = True
 	except prawcore.exceptions.SpecialError:
 		log.warning(f"Failed to save usernotes for r/{subreddit.name}, SpecialError")
 		if subreddit.backup_reddit is not None:
 			try:
-				subreddit.backup_reddit.subreddit(subreddit.name).wiki['usernotes'].edit(json.dumps(json_dict), reason=change_reason)
+				subreddit.backup_reddit.subreddit(subreddit.name).wiki['usernotes'].edit(content=json.dumps(json_dict), reason=change_reason, **edit_settings)
 				log.warning(f"Saved usernotes for r/{subreddit.name} with backup reddit")
+				saved = True
 			except prawcore.exceptions.SpecialError:
 				log.warning(f"Failed to save usernotes for r/{subreddit.name} with backup reddit, SpecialError")
 
+	# called before any other request, so a failure looking up the revision can't undo what the caller records here
+	if saved and on_saved is not None:
+		on_saved()
+
+	# keep the cache if the newest revision is the one we just saved, otherwise reload it next time
+	revision = get_usernotes_revision(subreddit) if saved else None
+	if revision is not None and revision['author'] is not None and revision['author'].name in subreddit.account_names():
+		subreddit.usernotes = sub_notes
+		subreddit.usernotes_revision = revision['id']
+		subreddit.usernotes_pending_ids = set()
+	return saved
+
+
+def add_usernote(subreddit, database, username, mod_name, type, note_text, permalink):
+	# the note is committed with the rest of the task so it survives a restart, the wiki is only written in flush_usernotes
+	pending_note = PendingNote(subreddit.name, username, mod_name, type, note_text, permalink)
+	database.session.add(pending_note)
+	database.session.flush()
+
+	if subreddit.usernotes is not None:
+		apply_pending_note(subreddit.usernotes, pending_note)
+		subreddit.usernotes_pending_ids.add(pending_note.id)
 
-def add_usernote(subreddit, username, mod_name, type, note_text, permalink):
-	sub_notes = get_usernotes(subreddit)
-	user_note = sub_notes.get_user_note(username)
-	note = Note.build_note(sub_notes, mod_name, type, note_text, datetime.utcnow(), permalink)
 
-	if user_note is not None:
-		user_note.add_new_note(note)
+def delete_pending_notes(database, pending_notes):
+	# the notes are on the wiki now, so drop them right away instead of leaving them to be applied again
+	for pending_note in pending_notes:
+		database.session.delete(pending_note)
+	database.session.commit()
+
+
+@stages.timed
+def flush_usernotes(subreddit, database, attempts=3):
+	pending_notes = get_pending_notes(subreddit, database)
+	if not len(pending_notes):
+		return
+
+	usernames = {pending_note.username for pending_note in pending_notes}
+	if len(usernames) == 1:
+		change_reason = f"\"create new note on user {next(iter(usernames))}\" via {subreddit.get_account_name()}"
 	else:
-		user_note = UserNotes(username)
-		user_note.add_new_note(note)
-		sub_notes.add_update_user_note(user_note)
-	save_usernotes(subreddit, sub_notes, f"\"create new note on user {username}\" via {subreddit.get_account_name()}")
+		change_reason = f"\"create new notes on {len(usernames)} users\" via {subreddit.get_account_name()}"
+
+	on_saved = functools.partial(delete_pending_notes, database, pending_notes)
+	for attempt in range(attempts):
+		sub_notes = get_usernotes(subreddit, database)
+		try:
+			saved = save_usernotes(subreddit, sub_notes, change_reason, previous_revision=subreddit.usernotes_revision, on_saved=on_saved)
+		except prawcore.exceptions.Conflict:
+			log.info(f"Usernotes for r/{subreddit.name} changed while saving, retrying")
+			continue
+
+		if saved:
+			log.info(f"Saved {len(pending_notes)} notes for r/{subreddit.name}")
+		return
+
+	log.warning(f"Couldn't save {len(pending_notes)} notes for r/{subreddit.name} after {attempts} attempts, will retry next loop")
+
+
+def sync_modmail_state(subreddit, database, state, limit, sync_time, incremental=True):
+	# listings are sorted by last update, so stop at the first conversation that hasn't changed since the last sync
+	cursor = database.get_modmail_cursor(subreddit.name, state) if incremental else None
+	rows = []
+	for conversation in subreddit.sub_object.modmail.conversations(state=state, sort='recent', limit=limit):
+		row = modmail_to_row(conversation, subreddit.name, state, sync_time)
+		if cursor is not None and row['last_updated'] < cursor:
+			break
+		rows.append(row)
+	database.add_modmail(rows)
+	log.debug(f"r/{subreddit.name}: Synced {len(rows)} {state} modmails")
+	return rows
 
 
-def warn_archive(author_obj, subreddit, subject, message):
+def warn_archive(author_obj, subreddit, database, subject, message):
 	try:
-		author_obj.message(
-			subject,
-			message,
-			from_subreddit=subreddit.name)
+		conversation = subreddit.sub_object.modmail.create(
+			subject=subject,
+			body=message,
+			recipient=author_obj)
 	except praw.exceptions.RedditAPIException:
 		log.warning(f"Error sending warning message to u/{author_obj.name}")
-	found = False
-	time.sleep(1)
-	for conversation in list(subreddit.all_modmail()):
-		#log.warning(f"{conversation.id} : {len(conversation.authors)} authors : u/{conversation.authors[0].name} : {len(conversation.messages)} messages")
-		if len(conversation.authors) == 2 and \
-				conversation.authors[0].name in {subreddit.get_account_name(), author_obj.name} and \
-				conversation.authors[1].name in {subreddit.get_account_name(), author_obj.name} and \
-				len(conversation.messages) == 1:
-			log.info(f"Archiving {conversation.authors[0].name} message: {conversation.id}")
-			conversation.archive()
-			subreddit.all_modmail().remove(conversation)
-			found = True
-			break
-	if not found:
-		log.warning(f"Couldn't find modmail to archive")
+		return
+
+	log.info(f"Archiving {subreddit.get_account_name()} message: {conversation.id}")
+	conversation.archive()
+	database.add_modmail([modmail_to_row(conversation, subreddit.name, 'archived', datetime.utcnow())])
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the bot's modules import each other by name from the src folder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
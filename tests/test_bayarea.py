@@ -0,0 +1,106 @@
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import bayarea
+from database import Comment, Database, DeferredComment, Submission, User
+
+
+class FakeReddit:
+	"""Just enough of a praw instance for the private profile check. Records the comments it removes"""
+	def __init__(self, remaining, profile_comments):
+		self.auth = SimpleNamespace(limits={'remaining': remaining, 'reset_timestamp': time.time() + 300, 'used': 0})
+		self.profile_comments = profile_comments
+		self.removed = []
+
+	def redditor(self, name):
+		return SimpleNamespace(comments=SimpleNamespace(new=lambda: list(range(self.profile_comments))))
+
+	def comment(self, comment_id):
+		return SimpleNamespace(mod=SimpleNamespace(remove=lambda: self.removed.append(comment_id)))
+
+
+def build(tmp_path, non_mod_remaining):
+	database = Database(str(tmp_path / "database.db"))
+	# a private profile shows its comments to the mod account but not to the non mod one
+	subreddit = SimpleNamespace(
+		name="bayarea",
+		sub_id=2,
+		approved=[],
+		restricted={'comment_days': 30, 'comments': 20, 'karma': 20, 'action': "remove"},
+		reddit=FakeReddit(1000, 5),
+		non_mod_reddit=FakeReddit(non_mod_remaining, 0),
+	)
+
+	author = User(name="private_author")
+	database.session.add(author)
+	submission = Submission(
+		submission_id="thread", created=datetime.utcnow(), is_restricted=True, author=author, subreddit_id=subreddit.sub_id)
+	database.session.add(submission)
+	old_date = datetime.utcnow() - timedelta(days=60)
+	for index in range(25):
+		database.session.add(Comment(
+			comment_id=f"old{index}", author=author, submission=submission, created=old_date, subreddit_id=subreddit.sub_id))
+	database.session.flush()
+	database.update_user_history(author, subreddit.sub_id, old_date, comments=25, comment_karma=100)
+	comment = Comment(comment_id="new", author=author, submission=submission, created=datetime.utcnow(), subreddit_id=subreddit.sub_id)
+	database.session.add(comment)
+	database.session.flush()
+	return database, subreddit, author, comment
+
+
+def deferred_ids(database, subreddit):
+	return [deferred_comment.comment_id for deferred_comment in database.get_deferred_comments(subreddit.sub_id)]
+
+
+def test_private_author_deferred_when_budget_exhausted(tmp_path):
+	database, subreddit, author, comment = build(tmp_path, non_mod_remaining=10)
+
+	author_result = bayarea.author_comment_restricted(subreddit, database, author)
+	assert author_result == bayarea.PROFILE_UNCHECKED
+	bayarea.action_comment(subreddit, database, comment, author_result)
+	assert deferred_ids(database, subreddit) == ["new"]
+	assert author.private_checked is None
+
+	# still no budget, so the comment keeps waiting
+	bayarea.recheck_deferred_comments(subreddit, database)
+	assert deferred_ids(database, subreddit) == ["new"]
+	assert subreddit.reddit.removed == []
+
+	subreddit.non_mod_reddit.auth.limits['remaining'] = 1000
+	bayarea.recheck_deferred_comments(subreddit, database)
+	assert deferred_ids(database, subreddit) == []
+	assert subreddit.reddit.removed == ["new"]
+	assert comment.is_removed
+	assert author.is_private
+	database.close()
+
+
+def test_deferred_comment_held_across_rechecks_and_restart(tmp_path):
+	database, subreddit, author, comment = build(tmp_path, non_mod_remaining=10)
+	bayarea.action_comment(subreddit, database, comment, bayarea.author_comment_restricted(subreddit, database, author))
+	for _ in range(3):
+		bayarea.recheck_deferred_comments(subreddit, database)
+		assert deferred_ids(database, subreddit) == ["new"]
+	database.close()
+
+	# a restarted bot picks the held comment back up from the database
+	database = Database(str(tmp_path / "database.db"))
+	for _ in range(3):
+		bayarea.recheck_deferred_comments(subreddit, database)
+		assert deferred_ids(database, subreddit) == ["new"]
+	assert subreddit.reddit.removed == []
+	assert database.session.query(Comment).filter_by(comment_id="new").first().is_removed is False
+
+	subreddit.non_mod_reddit.auth.limits['remaining'] = 1000
+	bayarea.recheck_deferred_comments(subreddit, database)
+	assert database.session.query(DeferredComment).count() == 0
+	assert subreddit.reddit.removed == ["new"]
+	database.close()
+
+
+def test_private_author_removed_when_budget_available(tmp_path):
+	database, subreddit, author, comment = build(tmp_path, non_mod_remaining=1000)
+
+	assert bayarea.author_comment_restricted(subreddit, database, author) == "private profile"
+	database.close()
@@ -0,0 +1,80 @@
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+import stages
+from database import Comment, Database, Submission, User
+
+
+def other_worker_insert(location, name):
+	# a second worker writing to the same file, giving up quickly instead of waiting out the real busy timeout
+	connection = sqlite3.connect(location, timeout=0.5)
+	try:
+		connection.execute("insert into users (name, is_deleted, is_private) values (?, 0, 0)", (name,))
+		connection.commit()
+	finally:
+		connection.close()
+
+
+def test_uncommitted_write_blocks_other_worker(tmp_path):
+	location = str(tmp_path / "database.db")
+	database = Database(location)
+	database.session.add(User(name="first"))
+	database.session.flush()
+
+	with pytest.raises(sqlite3.OperationalError, match="locked"):
+		other_worker_insert(location, "second")
+	database.close()
+
+
+def test_request_hook_releases_write_lock(tmp_path):
+	location = str(tmp_path / "database.db")
+	database = Database(location)
+	database.session.add(User(name="first"))
+	database.session.flush()
+
+	with stages.hook_requests(database.release_write_lock):
+		# a request from another thread, like a read pool worker, doesn't own the session so it leaves it alone
+		thread = threading.Thread(target=stages.wrap_context(stages.before_request))
+		thread.start()
+		thread.join()
+		with pytest.raises(sqlite3.OperationalError, match="locked"):
+			other_worker_insert(location, "second")
+
+		stages.before_request()
+		other_worker_insert(location, "second")
+
+	assert database.session.query(User).count() == 2
+	database.close()
+
+
+def test_bulk_user_history_counts_threshold_day_exactly(tmp_path):
+	database = Database(str(tmp_path / "database.db"))
+	author = User(name="author")
+	database.session.add(author)
+	submission = Submission(
+		submission_id="thread", created=datetime(2024, 5, 1), is_restricted=False, author=author, subreddit_id=2)
+	database.session.add(submission)
+	database.session.flush()
+	database.update_user_history(author, 2, submission.created, submissions=1)
+
+	threshold_date = datetime(2024, 5, 10, 12, 0)
+	created_dates = [
+		datetime(2024, 5, 9, 23, 0),
+		datetime(2024, 5, 10, 1, 0),
+		datetime(2024, 5, 10, 11, 59),
+		datetime(2024, 5, 10, 12, 30),
+		datetime(2024, 5, 11, 0, 0)]
+	for index, created in enumerate(created_dates):
+		comment = Comment(
+			comment_id=f"c{index}", author=author, submission=submission, created=created, subreddit_id=2, karma=10, is_removed=index == 1)
+		database.session.add(comment)
+		database.update_user_history(author, 2, created, comments=0 if comment.is_removed else 1, comment_karma=10)
+	database.session.flush()
+
+	assert database.get_bulk_user_history(2, [author.id], threshold_date)[author.id] == (2, 1, 30, 0)
+	comment_count, comment_karma = database.get_comment_counts(2, author, threshold_date, is_removed=False)
+	assert comment_count == 2
+	database.close()